@@ -18,7 +18,7 @@
 
 from flask import Flask, request
 from queue import Queue
-from services.webhook import send_webhook
+from services.webhook import send_webhook, prewarm_webhook
 import threading
 import uuid
 import os
@@ -51,6 +51,10 @@ def create_app():
                 "process_id": pid,
                 "response": None
             })
+
+            # Set up the webhook connection while the job runs (mostly waiting on ffmpeg)
+            if data.get("webhook_url"):
+                threading.Thread(target=prewarm_webhook, args=(data["webhook_url"],), daemon=True).start()
             
             response = task_func()
             run_time = time.time() - run_start_time
@@ -60,6 +60,34 @@ def log_job_status(job_id, data):
     with open(job_file, 'w') as f:
         json.dump(data, f, indent=2)
 
+def update_job_progress(job_id, progress):
+    """
+    Record the progress of a running job in its status file.
+    Best-effort: a status file that can't be read or written is skipped, so a
+    progress update never fails the job it reports on.
+    
+    Args:
+        job_id (str): The unique job ID
+        progress (float): Percent complete (0-100)
+    """
+    job_file = os.path.join(LOCAL_STORAGE_PATH, 'jobs', f"{job_id}.json")
+    try:
+        with open(job_file, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return
+
+    # Never overwrite a final status with a late progress update
+    if data.get("job_status") != "running":
+        return
+
+    data["progress"] = progress
+    try:
+        with open(job_file, 'w') as f:
+            json.dump(data, f, indent=2)
+    except OSError as e:
+        print(f"Could not record progress for job {job_id}: {e}")
+
 def queue_task_wrapper(bypass_queue=False):
     def decorator(f):
         def wrapper(*args, **kwargs):
@@ -27,6 +27,12 @@ if not API_KEY:
 # Storage path setting
 LOCAL_STORAGE_PATH = os.environ.get('LOCAL_STORAGE_PATH', '/tmp')
 
+# Size cap for the shared input download cache (0 disables it)
+DOWNLOAD_CACHE_MAX_MB = int(os.environ.get('DOWNLOAD_CACHE_MAX_MB', 2048))
+
+# Upper bound on ffmpeg re-encodes running at once in one worker process
+MAX_CONCURRENT_ENCODES = int(os.environ.get('MAX_CONCURRENT_ENCODES', 4))
+
 # GCP environment variables
 GCP_SA_CREDENTIALS = os.environ.get('GCP_SA_CREDENTIALS', '')
 GCP_BUCKET_NAME = os.environ.get('GCP_BUCKET_NAME', '')
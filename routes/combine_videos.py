@@ -16,12 +16,13 @@
 
 
 
+import os
 from flask import Blueprint
 from app_utils import *
 import logging
-from services.ffmpeg_toolkit import process_video_combination
+from services.ffmpeg_toolkit import process_video_combination, STORAGE_PATH
 from services.authentication import authenticate
-from services.cloud_storage import upload_file
+from services.cloud_storage import upload_file, start_streaming_upload
 
 combine_bp = Blueprint('combine', __name__)
 logger = logging.getLogger(__name__)
@@ -64,7 +65,11 @@ logger = logging.getLogger(__name__)
         # Normalization parameters used only when transitions are enabled
         "width":  {"type": "integer", "minimum": 2},
         "height": {"type": "integer", "minimum": 2},
-        "fps":    {"type": "integer", "minimum": 1}
+        "fps":    {"type": "integer", "minimum": 1},
+        "hw_accel": {"type": "string", "enum": ["auto", "none"]},
+        "stream_inputs": {"type": "boolean"},
+        "boundary_transition": {"type": "boolean"},
+        "smart_render": {"type": "boolean"}
     },
     "required": ["video_urls"],
     "additionalProperties": False
@@ -82,6 +87,10 @@ def combine_videos(job_id, data):
     width = int(data.get('width', 1280))
     height = int(data.get('height', 720))
     fps = int(data.get('fps', 30))
+    hw_accel = data.get('hw_accel', 'auto')
+    stream_inputs = bool(data.get('stream_inputs', False))
+    boundary_transition = bool(data.get('boundary_transition', True))
+    smart_render = bool(data.get('smart_render', False))
 
     logger.info(
         f"Job {job_id}: Received combine-videos request | "
@@ -90,7 +99,13 @@ def combine_videos(job_id, data):
         f"norm={width}x{height}@{fps} | id={id}"
     )
 
+    stream_upload = None
+
     try:
+        # Re-encoded outputs are written as fragmented MP4 and uploaded while they are encoded
+        if use_transitions:
+            stream_upload = start_streaming_upload(os.path.join(STORAGE_PATH, f"{job_id}.mp4"))
+
            # Delegate to ffmpeg toolkit with optional transition settings
         output_file = process_video_combination(
             media_urls,
@@ -101,15 +116,25 @@ def combine_videos(job_id, data):
             transition_durations=transition_durations,
             width=width,
             height=height,
-            fps=fps
+            fps=fps,
+            hw_accel=hw_accel,
+            stream_inputs=stream_inputs,
+            boundary_transition=boundary_transition,
+            smart_render=smart_render,
+            fragmented_output=stream_upload is not None,
+            progress_callback=lambda percent: update_job_progress(job_id, percent)
         )
         logger.info(f"Job {job_id}: Video combination process completed successfully")
 
-        cloud_url = upload_file(output_file)
+        cloud_url = stream_upload.finish() if stream_upload else None
+        if cloud_url is None:
+            cloud_url = upload_file(output_file)
         logger.info(f"Job {job_id}: Combined video uploaded to cloud storage: {cloud_url}")
 
         return cloud_url, "/combine-videos", 200
 
     except Exception as e:
+        if stream_upload:
+            stream_upload.abort()
         logger.error(f"Job {job_id}: Error during video combination process - {str(e)}")
         return str(e), "/combine-videos", 500
\ No newline at end of file
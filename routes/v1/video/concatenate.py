@@ -66,7 +66,8 @@ logger = logging.getLogger(__name__)
         "height": {"type": "integer", "minimum": 2},
         "fps":    {"type": "integer", "minimum": 1},
         "preserve_clip_starts": {"type": "boolean"},
-        "pad_color": {"type": "string"}       
+        "pad_color": {"type": "string"},
+        "hw_accel": {"type": "string", "enum": ["auto", "none"]}
     },
     "required": ["video_urls"],
     "additionalProperties": False
@@ -86,6 +87,7 @@ def combine_videos(job_id, data):
     fps = int(data.get('fps', 30))
     preserve_clip_starts = bool(data.get('preserve_clip_starts', True))
     pad_color = data.get('pad_color', 'black')
+    hw_accel = data.get('hw_accel', 'auto')
 
     logger.info(
         f"Job {job_id}: /combine-videos | clips={len(media_urls)} | transitions={use_transitions} "
@@ -105,7 +107,9 @@ def combine_videos(job_id, data):
             height=height,
             fps=fps,
             preserve_clip_starts=preserve_clip_starts,
-            pad_color=pad_color
+            pad_color=pad_color,
+            hw_accel=hw_accel,
+            progress_callback=lambda percent: update_job_progress(job_id, percent)
         )
 
         logger.info(f"Job {job_id}: Video combination process completed successfully")
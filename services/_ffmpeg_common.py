@@ -0,0 +1,815 @@
+# Copyright (c) 2025 Stephen G. Pope
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+
+import os
+import sys
+import json
+import math
+import fractions
+import functools
+import itertools
+import threading
+import struct
+import hashlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from services.file_management import download_file, download_file_cached, head_url, release_cached_download
+from config import LOCAL_STORAGE_PATH, MAX_CONCURRENT_ENCODES, DOWNLOAD_CACHE_MAX_MB
+
+try:
+    # Optional: PyAV probes other local containers in-process; without it they go through ffprobe
+    import av
+except ImportError:
+    av = None
+
+
+# Downloaded inputs are cached here (shared across jobs) when the server reports a Content-Length
+_DOWNLOAD_CACHE_DIR = "nca_download_cache"
+
+# Bytes / microseconds of packets ffprobe may read to identify streams. Container headers
+# (moov, EBML) carry duration and geometry, so the first packets are enough.
+_PROBE_SIZE = 100000
+_PROBE_ANALYZE_US = 100000
+# Seconds the bounded probe may take before it is abandoned for an unbounded one
+_PROBE_TIMEOUT = 5
+
+# Leading box types of an ISO-BMFF (MP4/MOV) file
+_MP4_LEADING_BOXES = {b"ftyp", b"moov", b"mdat", b"free", b"skip", b"wide"}
+# Sample entry types, as ffprobe names the codecs
+_MP4_CODECS = {b"avc1": "h264", b"avc3": "h264", b"hvc1": "hevc", b"hev1": "hevc", b"mp4a": "aac"}
+# H.264 profiles that only allow 8-bit 4:2:0 (Baseline, Main, Extended, High)
+_H264_420_PROFILES = {66, 77, 88, 100}
+
+def _mp4_boxes(f, end):
+    """Yield (type, payload_start, payload_end) for each box from f's position up to end."""
+    while f.tell() + 8 <= end:
+        start = f.tell()
+        size, kind = struct.unpack(">I4s", f.read(8))
+        header = 8
+        if size == 1:
+            size, header = struct.unpack(">Q", f.read(8))[0], 16
+        elif size == 0:
+            size = end - start
+        if size < header or start + size > end:
+            return
+        yield kind, start + header, start + size
+        f.seek(start + size)
+
+def _mp4_child(f, start, end, kind):
+    """(payload_start, payload_end) of the first child box of the given type, or None."""
+    f.seek(start)
+    return next(((s, e) for k, s, e in _mp4_boxes(f, end) if k == kind), None)
+
+def _mp4_sample_entry(f, mdia):
+    """
+    (start, end) of the first sample entry in a track's stsd, the track's stbl, and its
+    mdhd timescale and duration (in that timescale).
+    """
+    mdhd = _mp4_child(f, *mdia, b"mdhd")
+    f.seek(mdhd[0])
+    if f.read(1)[0] == 1:
+        f.seek(mdhd[0] + 20)
+        timescale, duration = struct.unpack(">IQ", f.read(12))
+    else:
+        f.seek(mdhd[0] + 12)
+        timescale, duration = struct.unpack(">II", f.read(8))
+    stbl = _mp4_child(f, *_mp4_child(f, *mdia, b"minf"), b"stbl")
+    stsd = _mp4_child(f, *stbl, b"stsd")
+    f.seek(stsd[0] + 8)
+    entry_size = struct.unpack(">I", f.read(4))[0]
+    return (stsd[0] + 8, stsd[0] + 8 + entry_size), stbl, timescale, duration
+
+def _mp4_rotation(f, trak):
+    """Display rotation (degrees, 0-359, as ffprobe reports it) from a track's tkhd matrix."""
+    tkhd = _mp4_child(f, *trak, b"tkhd")
+    f.seek(tkhd[0])
+    # The 3x3 matrix follows the version-dependent times, reserved fields, layer and volume
+    f.seek(tkhd[0] + (48 if f.read(1)[0] == 1 else 40))
+    a, b = struct.unpack(">ii", f.read(8))
+    return round(-math.degrees(math.atan2(b, a))) % 360
+
+def _probe_mp4(path):
+    """
+    Read the _probe_file fields straight from an MP4/MOV moov box.
+    Returns the same dict as _probe_file (pix_fmt is only known for H.264 profiles that
+    imply yuv420p), or None when the file is not a complete, non-fragmented MP4/MOV.
+    """
+    try:
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            if f.read(8)[4:] not in _MP4_LEADING_BOXES:
+                return None
+            moov = _mp4_child(f, 0, size, b"moov")
+            # Fragmented files carry their durations in the fragments, not in mvhd
+            if moov is None or _mp4_child(f, *moov, b"mvex") is not None:
+                return None
+            mvhd = _mp4_child(f, *moov, b"mvhd")
+            f.seek(mvhd[0])
+            if f.read(1)[0] == 1:
+                f.seek(mvhd[0] + 20)
+                timescale, duration = struct.unpack(">IQ", f.read(12))
+            else:
+                f.seek(mvhd[0] + 12)
+                timescale, duration = struct.unpack(">II", f.read(8))
+
+            probe = {"has_audio": False, "width": None, "height": None, "pix_fmt": None,
+                     "frame_rate": None, "sar": None, "sample_rate": None, "channels": None,
+                     "video_codec": None, "audio_codec": None, "rotation": None, "video_duration": None}
+            f.seek(moov[0])
+            traks = [(s, e) for k, s, e in _mp4_boxes(f, moov[1]) if k == b"trak"]
+            for trak in traks:
+                mdia = _mp4_child(f, *trak, b"mdia")
+                hdlr = _mp4_child(f, *mdia, b"hdlr")
+                f.seek(hdlr[0] + 8)
+                handler = f.read(4)
+                if handler == b"soun" and not probe["has_audio"]:
+                    probe["has_audio"] = True
+                    entry, _, _, _ = _mp4_sample_entry(f, mdia)
+                    f.seek(entry[0] + 4)
+                    probe["audio_codec"] = _MP4_CODECS.get(f.read(4))
+                    # AudioSampleEntry: channelcount at +24, 16.16 samplerate at +32
+                    f.seek(entry[0] + 24)
+                    probe["channels"] = struct.unpack(">H", f.read(2))[0]
+                    f.seek(entry[0] + 32)
+                    probe["sample_rate"] = struct.unpack(">I", f.read(4))[0] >> 16
+                elif handler == b"vide" and probe["width"] is None:
+                    probe["rotation"] = _mp4_rotation(f, trak)
+                    entry, stbl, track_timescale, track_duration = _mp4_sample_entry(f, mdia)
+                    probe["video_duration"] = track_duration / track_timescale
+                    f.seek(entry[0] + 4)
+                    probe["video_codec"] = _MP4_CODECS.get(f.read(4))
+                    # VisualSampleEntry: width/height at +32, child boxes (avcC, pasp, ...) from +86
+                    f.seek(entry[0] + 32)
+                    probe["width"], probe["height"] = struct.unpack(">HH", f.read(4))
+                    pasp = _mp4_child(f, entry[0] + 86, entry[1], b"pasp")
+                    if pasp is not None:
+                        f.seek(pasp[0])
+                        probe["sar"] = "%d:%d" % struct.unpack(">II", f.read(8))
+                    avcc = _mp4_child(f, entry[0] + 86, entry[1], b"avcC")
+                    if avcc is not None:
+                        f.seek(avcc[0] + 1)
+                        if f.read(1)[0] in _H264_420_PROFILES:
+                            probe["pix_fmt"] = "yuv420p"
+                    # A single stts run means every frame has the same duration (constant frame rate)
+                    stts = _mp4_child(f, *stbl, b"stts")
+                    f.seek(stts[0] + 4)
+                    if struct.unpack(">I", f.read(4))[0] == 1:
+                        delta = struct.unpack(">II", f.read(8))[1]
+                        rate = fractions.Fraction(track_timescale, delta)
+                        probe["frame_rate"] = f"{rate.numerator}/{rate.denominator}"
+    except (OSError, TypeError, IndexError, ZeroDivisionError, struct.error):
+        return None
+    if not timescale or not duration or not probe["width"] or not probe["height"]:
+        return None
+    probe["duration"] = duration / timescale
+    return probe
+
+def _probe_av(path):
+    """
+    Read the _probe_file fields through PyAV (libavformat in-process, no ffprobe fork).
+    Probing is bounded like ffprobe's first attempt. Returns the same dict as _probe_file,
+    or None when PyAV is not installed or the file yields no duration or video size.
+    """
+    if av is None:
+        return None
+    try:
+        with av.open(path, options={"probesize": str(_PROBE_SIZE), "analyzeduration": str(_PROBE_ANALYZE_US)}) as c:
+            if c.duration is None or not c.streams.video:
+                return None
+            v = c.streams.video[0]
+            a = c.streams.audio[0] if c.streams.audio else None
+            sar = v.sample_aspect_ratio
+            try:
+                # PyAV exposes the display matrix only on decoded frames
+                rotation = round(next(c.decode(v)).rotation) % 360
+            except (av.FFmpegError, StopIteration):
+                rotation = None
+            probe = {
+                "duration": c.duration / av.time_base,
+                "has_audio": a is not None,
+                "width": v.codec_context.width,
+                "height": v.codec_context.height,
+                "pix_fmt": v.codec_context.pix_fmt,
+                # Same constant-frame-rate test as ffprobe's r_frame_rate == avg_frame_rate
+                "frame_rate": (f"{v.average_rate.numerator}/{v.average_rate.denominator}"
+                               if v.average_rate and v.average_rate == v.base_rate else None),
+                "sar": f"{sar.numerator}:{sar.denominator}" if sar else None,
+                "sample_rate": a.codec_context.sample_rate if a is not None else None,
+                "channels": a.codec_context.channels if a is not None else None,
+                "video_codec": v.codec_context.name,
+                "audio_codec": a.codec_context.name if a is not None else None,
+                "rotation": rotation,
+                "video_duration": float(v.duration * v.time_base) if v.duration else None,
+            }
+    except (av.FFmpegError, OSError, ValueError):
+        return None
+    if not probe["duration"] or not probe["width"] or not probe["height"]:
+        return None
+    return probe
+
+def _mp4_avc_level(path):
+    """
+    (profile_idc, constraint flags, level_idc) from the avcC of path's first video track,
+    or None when path is not an MP4/MOV with an H.264 video track.
+    """
+    try:
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            moov = _mp4_child(f, 0, size, b"moov")
+            f.seek(moov[0])
+            for kind, start, end in list(_mp4_boxes(f, moov[1])):
+                if kind != b"trak":
+                    continue
+                mdia = _mp4_child(f, start, end, b"mdia")
+                hdlr = _mp4_child(f, *mdia, b"hdlr")
+                f.seek(hdlr[0] + 8)
+                if f.read(4) != b"vide":
+                    continue
+                entry, _, _, _ = _mp4_sample_entry(f, mdia)
+                avcc = _mp4_child(f, entry[0] + 86, entry[1], b"avcC")
+                if avcc is None:
+                    return None
+                f.seek(avcc[0] + 1)
+                return tuple(f.read(3))
+    except (OSError, TypeError, IndexError, struct.error):
+        return None
+    return None
+
+def _probe_file(path):
+    """
+    Probe duration, audio presence and the first video/audio streams' formats with a single ffprobe call.
+    Returns {"duration": float, "has_audio": bool, "width": int, "height": int, "pix_fmt": str,
+    "frame_rate": "num/den", "sar": "num:den", "sample_rate": int, "channels": int,
+    "video_codec": str, "audio_codec": str, "rotation": int, "video_duration": float}; fields that are unknown
+    (or, for frame_rate, not constant) are None. width/height are the coded size; rotation
+    (degrees) is the display rotation ffmpeg applies when decoding (see _display_size).
+    Only the first packets are sampled, within _PROBE_TIMEOUT; if that is not enough
+    to find a duration (e.g. headerless streams, a stalled remote read), the file is
+    probed again without either bound. Local MP4/MOV files are read without ffprobe, and
+    so are other local files when PyAV is installed.
+    """
+    if not path.startswith(("http://", "https://")):
+        probe = _probe_mp4(path) or _probe_av(path)
+        if probe is not None:
+            return probe
+    data = None
+    attempts = (
+        (["-probesize", str(_PROBE_SIZE), "-analyzeduration", str(_PROBE_ANALYZE_US)], _PROBE_TIMEOUT),
+        ([], None),
+    )
+    for bounds, timeout in attempts:
+        try:
+            r = subprocess.run([
+                "ffprobe", "-v", "error", *bounds,
+                "-show_entries",
+                "format=duration:stream=index,codec_type,codec_name,duration,width,height,pix_fmt,"
+                "r_frame_rate,avg_frame_rate,sample_aspect_ratio,sample_rate,channels:stream_side_data=rotation",
+                "-of", "json", path
+            ], capture_output=True, text=True, check=True, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            print(f"Bounded probe of {path} timed out, retrying without bounds")
+            continue
+        data = json.loads(r.stdout)
+        if data.get("format", {}).get("duration") not in (None, "N/A"):
+            break
+    streams = data.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), {})
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), {})
+    return {
+        "duration": float(data["format"]["duration"]),
+        "has_audio": bool(audio),
+        "width": video.get("width"),
+        "height": video.get("height"),
+        "pix_fmt": video.get("pix_fmt"),
+        # The nominal and average rates only agree for constant-frame-rate streams
+        "frame_rate": video.get("r_frame_rate") if video.get("r_frame_rate") == video.get("avg_frame_rate") else None,
+        "sar": video.get("sample_aspect_ratio"),
+        "sample_rate": int(audio["sample_rate"]) if audio.get("sample_rate") else None,
+        "channels": audio.get("channels"),
+        "video_codec": video.get("codec_name"),
+        "audio_codec": audio.get("codec_name"),
+        "video_duration": float(video["duration"]) if video.get("duration") not in (None, "N/A") else None,
+        "rotation": round(next(
+            (sd["rotation"] for sd in video.get("side_data_list", []) if "rotation" in sd), 0
+        )) % 360,
+    }
+
+def _keyframe_times(path):
+    """Presentation times (seconds, ascending) of the keyframes in path's first video stream."""
+    r = subprocess.run([
+        "ffprobe", "-v", "error", "-select_streams", "v:0",
+        "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", path
+    ], capture_output=True, text=True, check=True)
+    times = []
+    for line in r.stdout.splitlines():
+        pts, _, flags = line.partition(",")
+        if "K" in flags and pts not in ("", "N/A"):
+            times.append(float(pts))
+    return sorted(times)
+
+def _display_size(probe):
+    """
+    (width, height) of the probed clip as ffmpeg decodes it, i.e. after autorotation,
+    or (None, None) when unknown (including probes cached before rotation was recorded).
+    """
+    probe = probe or {}
+    rotation = probe.get("rotation")
+    if rotation is None or rotation % 90:
+        return None, None
+    if rotation % 180:
+        return probe.get("height"), probe.get("width")
+    return probe.get("width"), probe.get("height")
+
+def _video_duration(probe):
+    """
+    Length of the probed clip's video stream; the container duration when the stream's own
+    is unknown. The container duration is the longest stream's, e.g. audio running past the video.
+    """
+    return probe.get("video_duration") or probe["duration"]
+
+def _matches_fps(probe, fps):
+    """True if the probed clip is already constant fps frames per second (so an fps filter is a no-op)."""
+    rate = (probe or {}).get("frame_rate")
+    return bool(rate) and rate != "0/0" and fractions.Fraction(rate) == fps
+
+def _is_stereo_48k(probe):
+    """True if the probed clip's audio is already 2-channel 48 kHz."""
+    return (probe or {}).get("channels") == 2 and (probe or {}).get("sample_rate") == 48000
+
+# Probe caches are append-only JSON-lines files shared by all worker processes: a put appends
+# one {"key", "entry"} line, and a lookup that misses in memory reads only the lines appended
+# since this process last looked. A file is compacted to its newest _PROBE_CACHE_MAX_ENTRIES
+# entries once it holds twice that many lines.
+_PROBE_CACHE_MAX_ENTRIES = 4096
+_json_caches = {}
+_json_cache_lock = threading.Lock()
+
+def _refresh_json_cache(path):
+    """
+    Bring this process's copy of the cache file at path up to date and return it
+    ({"entries", "inode", "offset", "lines"}). The caller holds _json_cache_lock.
+    """
+    state = _json_caches.get(path)
+    try:
+        f = open(path, "rb")
+    except OSError:
+        if state is None:
+            state = _json_caches[path] = {"entries": {}, "inode": None, "offset": 0, "lines": 0}
+        return state
+    with f:
+        inode = os.fstat(f.fileno()).st_ino
+        if state is None or state["inode"] != inode:
+            # First look, or another process compacted the file: read it from the start
+            state = _json_caches[path] = {"entries": {}, "inode": inode, "offset": 0, "lines": 0}
+        f.seek(state["offset"])
+        data = f.read()
+    # Only complete lines; one still being appended is picked up next time
+    end = data.rfind(b"\n") + 1
+    for line in data[:end].splitlines():
+        try:
+            record = json.loads(line)
+            key, entry = record["key"], record["entry"]
+        except (ValueError, KeyError, TypeError):
+            continue
+        state["entries"].pop(key, None)
+        state["entries"][key] = entry
+        state["lines"] += 1
+    state["offset"] += end
+    return state
+
+def _json_cache_get(path, key):
+    """Return the entry stored under key in the cache file at path, or None."""
+    with _json_cache_lock:
+        state = _json_caches.get(path)
+        if state is None or key not in state["entries"]:
+            state = _refresh_json_cache(path)
+        return state["entries"].get(key)
+
+def _json_cache_put(path, key, entry):
+    """Store entry under key, in memory and on disk (one appended line)."""
+    line = json.dumps({"key": key, "entry": entry}) + "\n"
+    try:
+        # A single short append, so concurrent writers' lines never interleave
+        with open(path, "a") as f:
+            f.write(line)
+    except OSError as e:
+        print(f"Could not persist probe cache: {e}")
+    with _json_cache_lock:
+        state = _refresh_json_cache(path)
+        state["entries"].pop(key, None)
+        state["entries"][key] = entry
+        if state["lines"] > 2 * _PROBE_CACHE_MAX_ENTRIES:
+            _compact_json_cache(path, state)
+
+def _compact_json_cache(path, state):
+    """Rewrite the cache file at path with only its newest _PROBE_CACHE_MAX_ENTRIES entries."""
+    keep = list(state["entries"].items())[-_PROBE_CACHE_MAX_ENTRIES:]
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            f.write("".join(json.dumps({"key": k, "entry": v}) + "\n" for k, v in keep))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not compact probe cache: {e}")
+        return
+    # The next refresh sees the new inode and reloads the compacted file
+    state["entries"] = dict(keep)
+    state["lines"] = len(keep)
+
+# Probes of local files, keyed by a fingerprint of their content (so a re-download of the same clip hits)
+_FINGERPRINT_CACHE_FILE = "nca_probe_fingerprints.jsonl"
+_FINGERPRINT_BYTES = 64 * 1024
+
+def _fingerprint(path):
+    """sha1 over the file size and its first and last 64 KiB."""
+    size = os.path.getsize(path)
+    h = hashlib.sha1(str(size).encode())
+    with open(path, "rb") as f:
+        h.update(f.read(_FINGERPRINT_BYTES))
+        if size > _FINGERPRINT_BYTES:
+            f.seek(max(_FINGERPRINT_BYTES, size - _FINGERPRINT_BYTES))
+            h.update(f.read())
+    return h.hexdigest()
+
+def _probe_file_cached(path):
+    """_probe_file(path) for a local file, answered from the fingerprint cache when the same content was probed before."""
+    cache_path = os.path.join(LOCAL_STORAGE_PATH, _FINGERPRINT_CACHE_FILE)
+    key = _fingerprint(path)
+    probe = _json_cache_get(cache_path, key)
+    if probe is None:
+        probe = _probe_file(path)
+        _json_cache_put(cache_path, key, probe)
+    return probe
+
+@functools.lru_cache(maxsize=None)
+def _ffmpeg_encoders():
+    """The local ffmpeg build's -encoders listing (probed once per process), b"" if ffmpeg can't be run."""
+    try:
+        r = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return b""
+    return r.stdout
+
+@functools.lru_cache(maxsize=None)
+def _ffmpeg_hwaccels():
+    """Names of the hardware decoders (-hwaccels) the local ffmpeg build has, probed once per process."""
+    try:
+        r = subprocess.run(["ffmpeg", "-hide_banner", "-hwaccels"], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return []
+    # First line is the "Hardware acceleration methods:" header
+    return [line.strip() for line in r.stdout.splitlines()[1:] if line.strip()]
+
+@functools.lru_cache(maxsize=None)
+def _cuda_device_count():
+    """Number of NVIDIA GPUs usable by ffmpeg in this process (probed once), 0 if unknown."""
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible is not None:
+        return len([d for d in visible.split(",") if d.strip()])
+    try:
+        r = subprocess.run(["nvidia-smi", "-L"], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return 0
+    return sum(1 for line in r.stdout.splitlines() if line.startswith("GPU "))
+
+_gpu_counter = itertools.count()
+
+def _next_gpu():
+    """Round-robin a GPU index across jobs on multi-GPU hosts; None on single-GPU hosts (ffmpeg default)."""
+    count = _cuda_device_count()
+    return next(_gpu_counter) % count if count > 1 else None
+
+# DRM render node used by the Intel/AMD encoders (QSV, VAAPI)
+_DRI_RENDER_NODE = "/dev/dri/renderD128"
+# Hardware H.264 encoders don't take frames wider or taller than this
+_HW_MAX_SIDE = 4096
+
+def _hw_encoder(hw_accel, width, height):
+    """
+    Resolve the hw_accel option to the hardware encoder for a width x height output.
+    - "auto": the first one the ffmpeg build (and host) supports, in the order "nvenc",
+      "qsv", "vaapi", "videotoolbox". If there is none (or the output is too large for
+      them), "libx264": encode on the CPU but let ffmpeg decode on whatever hardware it
+      finds (-hwaccel auto); None when the build has no hardware decoders either.
+    - "none": None, i.e. decode and encode on the CPU (libx264).
+    """
+    if hw_accel not in ("auto", "none"):
+        raise ValueError(f"Unsupported hw_accel value: {hw_accel}")
+    if hw_accel == "none":
+        return None
+    fallback = "libx264" if _ffmpeg_hwaccels() else None
+    if max(width, height) > _HW_MAX_SIDE:
+        return fallback
+    encoders = _ffmpeg_encoders()
+    # Distro and static builds list NVENC on hosts without a GPU too, so also require a device
+    if b"h264_nvenc" in encoders and _cuda_device_count() > 0:
+        return "nvenc"
+    if os.path.exists(_DRI_RENDER_NODE):
+        if b"h264_qsv" in encoders:
+            return "qsv"
+        if b"h264_vaapi" in encoders:
+            return "vaapi"
+    if sys.platform == "darwin" and b"h264_videotoolbox" in encoders:
+        return "videotoolbox"
+    return fallback
+
+def _hw_upload_filter(encoder):
+    """Filter that moves the finished frames into the encoder's memory, or None if it takes system memory frames."""
+    return "format=nv12,hwupload" if encoder == "vaapi" else None
+
+@functools.lru_cache(maxsize=None)
+def _npp_available():
+    """Return True if the local ffmpeg build exposes the scale_npp CUDA filter (probed once per process)."""
+    try:
+        r = subprocess.run(["ffmpeg", "-hide_banner", "-filters"], capture_output=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return b"scale_npp" in r.stdout
+
+def _scale_pad_filter(width, height, cuda_frames, probe=None):
+    """
+    Scale-to-fit + pad chain normalizing a clip to width x height, SAR 1, yuv420p.
+    With cuda_frames the scale runs on the GPU (scale_npp) and every frame is
+    downloaded once, already at the target size, for the CPU pad/xfade stages.
+    Given the clip's probe, steps it already satisfies are left out: pad when its
+    aspect ratio matches, scale when its size matches, setsar when its pixels are
+    square, format when it is yuv420p. The result may then be empty. Sizes are compared
+    as displayed (after ffmpeg's autorotation); a clip of unknown rotation is always
+    scaled and padded.
+    """
+    in_w, in_h = _display_size(probe)
+    same_aspect = bool(in_w and in_h) and in_w * height == in_h * width
+    pad = f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2"
+    if cuda_frames:
+        # scale_npp also does the NV12 -> yuv420p conversion hwdownload needs, so it always stays
+        if same_aspect:
+            return f"scale_npp={width}:{height}:format=yuv420p,hwdownload,format=yuv420p,setsar=1"
+        return (
+            f"scale_npp={width}:{height}:force_original_aspect_ratio=decrease:format=yuv420p,"
+            f"hwdownload,format=yuv420p,{pad},setsar=1"
+        )
+    steps = []
+    if not same_aspect:
+        steps += [f"scale={width}:{height}:force_original_aspect_ratio=decrease", pad]
+    elif (in_w, in_h) != (width, height):
+        steps.append(f"scale={width}:{height}")
+    if (probe or {}).get("sar") != "1:1":
+        steps.append("setsar=1")
+    if (probe or {}).get("pix_fmt") != "yuv420p":
+        steps.append("format=yuv420p")
+    return ",".join(steps)
+
+def _video_codec_args(encoder, gpu=None):
+    """Video encoder arguments for the re-encode (transition) path; encoder is from _hw_encoder."""
+    # The graph skips format=yuv420p for clips already in it, so pin the encoder's input
+    # format too; otherwise the encoders may negotiate 4:4:4 (which most players can't decode)
+    if encoder == "nvenc":
+        args = ["-c:v", "h264_nvenc", "-preset", "p4", "-tune", "ll",
+                "-rc", "vbr", "-cq", "23", "-b:v", "0", "-pix_fmt", "yuv420p"]
+        if gpu is not None:
+            args += ["-gpu", str(gpu)]
+        return args
+    if encoder == "qsv":
+        return ["-c:v", "h264_qsv", "-preset", "veryfast", "-global_quality", "19", "-pix_fmt", "nv12"]
+    if encoder == "vaapi":
+        # Frames arrive as VAAPI surfaces (see _hw_upload_filter)
+        return ["-c:v", "h264_vaapi", "-qp", "19"]
+    if encoder == "videotoolbox":
+        return ["-c:v", "h264_videotoolbox", "-q:v", "65", "-pix_fmt", "yuv420p"]
+    # Size x264's thread pool to the host instead of relying on ffmpeg's heuristics. Frame
+    # threading (not slices): the output is written offline, so the extra frames of latency
+    # don't matter and it compresses better and scales further than sliced threads
+    threads = os.cpu_count() or 4
+    return ["-c:v", "libx264", "-x264-params", f"threads={threads}:sliced-threads=0:lookahead-threads=1",
+            "-preset", "veryfast", "-crf", "18", "-pix_fmt", "yuv420p"]
+
+# Fragmented MP4 is written strictly front to back (no moov relocation pass), so it can be uploaded while encoding
+_FRAGMENTED_MOVFLAGS = ["-movflags", "+frag_keyframe+empty_moov+default_base_moof", "-frag_duration", "1000000"]
+
+def _transition_cmd(input_files, graph_path, v_out, a_out, output_path, encoder, cuda_frames, gpu=None,
+                    genpts=False, fragmented=False, video_args=()):
+    """
+    Assemble the ffmpeg argv for the transition (re-encode) path.
+    genpts regenerates timestamps missing on the inputs and in the output;
+    fragmented writes fragmented MP4 instead of +faststart; video_args are
+    appended to the encoder's arguments (e.g. to pin a profile and level).
+    """
+    cmd = ["ffmpeg", "-y"]
+    if encoder == "vaapi":
+        cmd += ["-vaapi_device", _DRI_RENDER_NODE]
+    for p in input_files:
+        if encoder == "libx264":
+            # Hardware decode where ffmpeg finds a device for the codec (software otherwise);
+            # frames come back to system memory for the CPU filters
+            cmd += ["-hwaccel", "auto"]
+        elif encoder == "nvenc":
+            # Decode on NVDEC; with cuda_frames the frames stay in VRAM for scale_npp
+            cmd += ["-hwaccel", "cuda"]
+            if gpu is not None:
+                cmd += ["-hwaccel_device", str(gpu)]
+            if cuda_frames:
+                cmd += ["-hwaccel_output_format", "cuda"]
+        if p.startswith(("http://", "https://")):
+            # Streamed input: survive dropped connections instead of failing the whole render
+            cmd += ["-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "5"]
+        if genpts:
+            cmd += ["-fflags", "+genpts"]
+        cmd += ["-i", p]
+    cmd += [
+        # Graph is read from a file so argv stays small however many clips are joined
+        # ("-/opt file" is ffmpeg 7's form of the deprecated -filter_complex_script)
+        "-/filter_complex", graph_path,
+        "-map", f"[{v_out}]",
+        "-map", f"[{a_out}]",
+        *_video_codec_args(encoder, gpu), *video_args,
+        "-c:a", "aac",
+        *(_FRAGMENTED_MOVFLAGS if fragmented else ["-movflags", "+faststart"]),
+        # The per-input normalization chains and the xfade chain run in parallel on every core
+        "-threads", "0", "-filter_complex_threads", str(os.cpu_count() or 4),
+    ]
+    if genpts:
+        cmd += ["-fflags", "+genpts"]
+    cmd.append(output_path)
+    return cmd
+
+# Concurrent re-encodes would only contend for the same cores/NVENC sessions
+_encode_slots = threading.BoundedSemaphore(max(1, min(os.cpu_count() or 1, MAX_CONCURRENT_ENCODES)))
+
+def _run_ffmpeg(cmd, total_duration, progress_callback=None):
+    """
+    Run an ffmpeg command, reporting progress from its -progress stream.
+    - progress_callback(percent) is called whenever another whole percent of
+      total_duration (seconds of output) has been encoded.
+    - Raises subprocess.CalledProcessError on failure, like subprocess.run(check=True).
+      If reading the progress stream (or progress_callback) raises, ffmpeg is killed
+      before the exception propagates, so it never outlives a failed job.
+    """
+    cmd = cmd[:1] + ["-progress", "pipe:1", "-nostats"] + cmd[1:]
+    reported = -1
+    with _encode_slots:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+        try:
+            for line in proc.stdout:
+                key, _, value = line.strip().partition("=")
+                # out_time_ms is in microseconds despite its name; it is "N/A" until the first frame
+                if key != "out_time_ms" or not value.isdigit() or not progress_callback or total_duration <= 0:
+                    continue
+                percent = min(int(value) / 1_000_000 / total_duration * 100, 100.0)
+                if int(percent) > reported:
+                    reported = int(percent)
+                    progress_callback(reported)
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            proc.wait()
+            proc.stdout.close()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+def _concat_copy(paths, output_path, output_args=(), spans=None, input_args=()):
+    """
+    Join paths into output_path with the concat demuxer and -c copy.
+    The file list is fed to ffmpeg on stdin instead of being written to disk.
+    spans ((start, end) seconds, one per path) join just that part of each file, so
+    the next file starts exactly where it ends (by default each file lasts as long as
+    its longest stream); input_args follow the list input (e.g. further -i inputs for
+    a graph mapped in output_args).
+    """
+    # Entries are resolved relative to the list's URL (pipe:), so name them as file: URLs
+    listing = "".join(
+        f"file 'file:{os.path.abspath(p)}'\n"
+        + (f"inpoint {spans[i][0]:.6f}\nduration {spans[i][1] - spans[i][0]:.6f}\n" if spans else "")
+        for i, p in enumerate(paths)
+    )
+    subprocess.run([
+        "ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0",
+        "-protocol_whitelist", "file,pipe", "-i", "pipe:0", *input_args, "-c", "copy", *output_args, output_path
+    ], input=listing.encode(), check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+def _normalize_list(value, target_len):
+    """
+    Normalize a parameter that can be either a scalar or a list to a list of length target_len.
+    - If scalar: replicate it.
+    - If list shorter: pad with its last value.
+    - If list longer: truncate.
+    """
+    if isinstance(value, (str, float, int)):
+        return [value] * target_len
+    if not isinstance(value, (list, tuple)):
+        raise ValueError("Parameter must be a scalar or a list/tuple.")
+    if not value:
+        raise ValueError("Parameter list must not be empty.")
+    return list(itertools.islice(itertools.chain(value, itertools.repeat(value[-1])), target_len))
+
+def _remove_in_background(paths):
+    """
+    Unlink paths on a daemon thread so the job can return without waiting on the filesystem.
+    Paths that don't exist are skipped, so callers needn't stat them first.
+    """
+    def _remove():
+        # One after another: unlinks in the same directory serialize on its lock anyway
+        for p in paths:
+            try:
+                os.unlink(p)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Could not remove {p}: {e}")
+    threading.Thread(target=_remove, daemon=True).start()
+
+def _is_cached_download(path, storage_dir):
+    """True if path lives in storage_dir's shared download cache (and so must outlive the job)."""
+    # download_file_cached returns absolute paths, so compare against the resolved cache directory
+    return path.startswith(os.path.join(os.path.abspath(storage_dir), _DOWNLOAD_CACHE_DIR) + os.sep)
+
+def _fetch_input(url, dest, storage_dir, probe=None):
+    """
+    Download one input (reusing a copy in storage_dir's download cache if unchanged) and,
+    if probe is given, call probe(url, path, headers) in the same worker.
+    headers are those of the HEAD request made for url ({} if it failed).
+    """
+    headers = head_url(url)
+    path = download_file_cached(
+        url, os.path.join(storage_dir, _DOWNLOAD_CACHE_DIR), DOWNLOAD_CACHE_MAX_MB * 1024 * 1024, headers
+    ) or download_file(url, dest)
+    try:
+        return path, (probe(url, path, headers) if probe else None)
+    except BaseException:
+        # The caller never sees path, so drop its lease (or delete the job's copy) here
+        _release_inputs([path], storage_dir)
+        raise
+
+def _download_inputs(media_urls, job_id, storage_dir, probe=None):
+    """
+    Download all media_urls into storage_dir concurrently, probing each file as soon as it
+    lands when probe is given (see _fetch_input).
+    Returns (input_files, probes) in the same order as media_urls; probes holds None without probe.
+    """
+    input_files = [None] * len(media_urls)
+    probes = [None] * len(media_urls)
+    with ThreadPoolExecutor(max_workers=min(16, len(media_urls))) as ex:
+        futures = {
+            ex.submit(_fetch_input, m['video_url'], os.path.join(storage_dir, f"{job_id}_input_{i}"),
+                      storage_dir, probe): i
+            for i, m in enumerate(media_urls)
+        }
+        try:
+            for fut in as_completed(futures):
+                input_files[futures[fut]], probes[futures[fut]] = fut.result()
+        except Exception:
+            # Don't start the remaining downloads once one has failed; clean up after the ones that finished
+            for fut in futures:
+                fut.cancel()
+            ex.shutdown(wait=True)
+            _release_inputs(
+                [fut.result()[0] for fut in futures if not fut.cancelled() and fut.exception() is None], storage_dir
+            )
+            raise
+    return input_files, probes
+
+def _release_inputs(input_files, storage_dir):
+    """
+    Clean up after _download_inputs: delete the job's own downloads (in the background)
+    and release its leases on shared cached ones.
+    """
+    own = []
+    for path in input_files:
+        if path is None:
+            continue
+        if _is_cached_download(path, storage_dir):
+            release_cached_download(path)
+        else:
+            own.append(path)
+    _remove_in_background(own)
+
+def _render_with_fallback(render, encoder, output_path):
+    """
+    Run render(encoder) and, if that fails on a hardware encoder, once more in software (render(None)).
+    The retry starts on a fresh output_path so a reader of the partial output can tell it was replaced.
+    """
+    try:
+        render(encoder)
+    except subprocess.CalledProcessError:
+        if encoder is None:
+            raise
+        # Hardware path unusable here (no device, driver mismatch, codec the decoder can't handle): retry on the CPU
+        print(f"Hardware-accelerated ({encoder}) transition render failed, retrying in software with libx264")
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        render(None)
@@ -16,11 +16,14 @@
 
 
 
+import io
 import os
+import time
 import logging
+import threading
 from abc import ABC, abstractmethod
 from services.gcp_toolkit import upload_to_gcs
-from services.s3_toolkit import upload_to_s3
+from services.s3_toolkit import upload_to_s3, upload_fileobj_to_s3
 from config import validate_env_vars
 from urllib.parse import urlparse
 
@@ -43,6 +46,12 @@ class CloudStorageProvider(ABC):
     def upload_file(self, file_path: str) -> str:
         pass
 
+    # Providers that can upload from a sequential stream set this and implement upload_fileobj
+    supports_streaming = False
+
+    def upload_fileobj(self, fileobj, file_name: str) -> str:
+        raise NotImplementedError(f"{type(self).__name__} does not support streamed uploads")
+
 class GCPStorageProvider(CloudStorageProvider):
     def __init__(self):
         self.bucket_name = os.getenv('GCP_BUCKET_NAME')
@@ -51,6 +60,8 @@ class GCPStorageProvider(CloudStorageProvider):
         return upload_to_gcs(file_path, self.bucket_name)
 
 class S3CompatibleProvider(CloudStorageProvider):
+    supports_streaming = True
+
     def __init__(self):
 
         self.endpoint_url = os.getenv('S3_ENDPOINT_URL')
@@ -86,6 +97,9 @@ class S3CompatibleProvider(CloudStorageProvider):
     def upload_file(self, file_path: str) -> str:
         return upload_to_s3(file_path, self.endpoint_url, self.access_key, self.secret_key, self.bucket_name, self.region)
 
+    def upload_fileobj(self, fileobj, file_name: str) -> str:
+        return upload_fileobj_to_s3(fileobj, file_name, self.endpoint_url, self.access_key, self.secret_key, self.bucket_name, self.region)
+
 def get_storage_provider() -> CloudStorageProvider:
     
     if os.getenv('S3_ENDPOINT_URL'):
@@ -115,4 +129,105 @@ def upload_file(file_path: str) -> str:
     except Exception as e:
         logger.error(f"Error uploading file to cloud storage: {e}")
         raise
-    
\ No newline at end of file
+    
+
+class _GrowingFile(io.RawIOBase):
+    """Sequential reader over a file that another process is still appending to."""
+
+    def __init__(self, path, finished, aborted, poll_interval=0.25):
+        self._path = path
+        self._finished = finished
+        self._aborted = aborted
+        self._poll_interval = poll_interval
+        self._f = None
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def _replaced(self):
+        # A writer that restarts from scratch unlinks and recreates the file
+        try:
+            return os.stat(self._path).st_ino != os.fstat(self._f.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def readinto(self, b):
+        while True:
+            if self._aborted.is_set():
+                raise IOError(f"Streaming upload of {self._path} aborted")
+            # Sample the flag before reading so bytes written just before it was set are not missed
+            finished = self._finished.is_set()
+            if self._f is None:
+                try:
+                    self._f = open(self._path, 'rb')
+                except FileNotFoundError:
+                    if finished:
+                        raise
+                    time.sleep(self._poll_interval)
+                    continue
+            n = self._f.readinto(b)
+            if n:
+                self._pos += n
+                return n
+            if self._replaced():
+                raise IOError(f"{self._path} was rewritten during the streaming upload")
+            if finished:
+                return 0
+            time.sleep(self._poll_interval)
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+        super().close()
+
+class StreamingUpload:
+    """
+    Upload a file to cloud storage while it is still being written (see start_streaming_upload).
+
+    Call finish() once the writer is done; it returns the URL, or None if the
+    streamed upload failed, in which case the finished file should be uploaded
+    with upload_file(). Call abort() if the writer failed.
+    """
+
+    def __init__(self, provider: CloudStorageProvider, file_path: str):
+        self._provider = provider
+        self._file_path = file_path
+        self._finished = threading.Event()
+        self._aborted = threading.Event()
+        self._url = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            stream = io.BufferedReader(_GrowingFile(self._file_path, self._finished, self._aborted), 1024 * 1024)
+            with stream:
+                logger.info(f"Streaming file to cloud storage while it is written: {self._file_path}")
+                self._url = self._provider.upload_fileobj(stream, os.path.basename(self._file_path))
+            logger.info(f"File uploaded successfully: {self._url}")
+        except Exception as e:
+            if not self._aborted.is_set():
+                logger.warning(f"Streaming upload of {self._file_path} failed, falling back to a regular upload: {e}")
+
+    def finish(self):
+        self._finished.set()
+        self._thread.join()
+        return self._url
+
+    def abort(self):
+        self._aborted.set()
+
+def start_streaming_upload(file_path: str):
+    """
+    Start uploading file_path while it is being written, for outputs written strictly
+    front to back (e.g. fragmented MP4). Returns a StreamingUpload, or None when the
+    configured provider cannot upload from a stream.
+    """
+    provider = get_storage_provider()
+    if not provider.supports_streaming:
+        return None
+    return StreamingUpload(provider, file_path)
@@ -18,48 +18,409 @@
 
 import os
 import json
+import math
+import hashlib
+import functools
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 import ffmpeg
-from services.file_management import download_file
+from services.file_management import download_file, head_url
+from services._ffmpeg_common import (
+    _json_cache_get, _json_cache_put, _probe_file, _probe_file_cached,
+    _keyframe_times, _mp4_avc_level, _display_size, _video_duration, _matches_fps, _is_stereo_48k, _hw_encoder, _hw_upload_filter, _npp_available, _next_gpu,
+    _scale_pad_filter,
+    _FRAGMENTED_MOVFLAGS, _transition_cmd, _run_ffmpeg, _concat_copy, _normalize_list, _remove_in_background,
+    _download_inputs, _release_inputs, _render_with_fallback
+)
 from config import STORAGE_PATH
 
 # --- Helpers ---------------------------------------------------------------
 
-def _probe_duration(path):
-    """Get media duration in seconds using ffprobe (format duration)."""
-    r = subprocess.run([
-        "ffprobe", "-v", "error",
-        "-show_entries", "format=duration",
-        "-of", "json", path
-    ], capture_output=True, text=True, check=True)
-    data = json.loads(r.stdout)
-    return float(data["format"]["duration"])
+# Probe results persisted across jobs, keyed by sha1(url) and validated with the URL's ETag/Content-Length
+_PROBE_CACHE_FILE = "nca_probe_cache.jsonl"
+
+def _url_validator(headers):
+    """Return the ETag (or Content-Length) from a HEAD response, or None if it has neither."""
+    return headers.get("ETag") or headers.get("Content-Length")
+
+def _probe_cache_get(url, validator):
+    """Return the cached probe for url if it was recorded under the same validator."""
+    entry = _json_cache_get(os.path.join(STORAGE_PATH, _PROBE_CACHE_FILE), hashlib.sha1(url.encode()).hexdigest())
+    if entry and entry.get("etag") == validator:
+        return entry["probe"]
+    return None
+
+def _probe_cache_put(url, validator, probe):
+    """Record probe for url under validator, in memory and on disk."""
+    _json_cache_put(
+        os.path.join(STORAGE_PATH, _PROBE_CACHE_FILE), hashlib.sha1(url.encode()).hexdigest(),
+        {"etag": validator, "probe": probe}
+    )
+
+def _probe_cached(url, path, headers=None):
+    """
+    _probe_file(path) for the content behind url, answered from the probe cache
+    when url still reports the same ETag/Content-Length as when it was last probed
+    (or, for a downloaded file, when the same content was probed under another URL).
+    """
+    validator = _url_validator(head_url(url) if headers is None else headers)
+    if validator is not None:
+        cached = _probe_cache_get(url, validator)
+        if cached is not None:
+            return cached
+    probe = _probe_file(path) if path == url else _probe_file_cached(path)
+    if validator is not None:
+        _probe_cache_put(url, validator, probe)
+    return probe
+
+def _probe_urls(urls):
+    """Probe remote inputs in place (ffprobe reads http(s) directly), in parallel, order preserved."""
+    with ThreadPoolExecutor(max_workers=min(16, len(urls))) as ex:
+        return list(ex.map(lambda url: _probe_cached(url, url), urls))
+
+# Fixed audio filter pieces of the transition graph
+_AUDIO_NORM = "aformat=channel_layouts=stereo,aresample=48000"
+_SILENCE = "anullsrc=channel_layout=stereo:sample_rate=48000"
+
+def _render_transitions(input_files, probes, transitions_norm, durations_norm,
+                        output_path, width, height, fps, encoder, progress_callback=None, fragmented=False,
+                        video_args=()):
+    """
+    Build the xfade/acrossfade filter graph for input_files and encode it to output_path.
+    Each clip lasts as long as its video; audio running past it is cut there.
+    video_args are extra encoder arguments (see _transition_cmd).
+    """
+    # Keep frames on the GPU through the scale step when NVENC and scale_npp are both available
+    cuda_frames = encoder == "nvenc" and _npp_available()
+    # Pin decode + encode of this job to one GPU so concurrent jobs spread across all of them
+    gpu = _next_gpu() if encoder == "nvenc" else None
+    durations = [_video_duration(pr) for pr in probes]
+    audio_flags = [pr["has_audio"] for pr in probes]
+
+    filter_lines = []
+    v_labels, a_labels = [], []
+
+    # Normalize each input (scale, fps, audio). The video chain only varies with the
+    # clip's format, so it is built once per distinct (width, height, rotation, pix_fmt, sar, fps match).
+    # Steps a clip already satisfies are left out. xfade needs every input on the same
+    # time base, so a clip already at fps only has its timestamps rescaled (settb).
+    v_chains = {}
+    for idx, pr in enumerate(probes):
+        vlab = f"v{idx}"
+        alab = f"a{idx}"
+        key = (*_display_size(pr), pr.get("pix_fmt"), pr.get("sar"), _matches_fps(pr, fps))
+        if key not in v_chains:
+            steps = [f"settb=1/{fps}" if key[-1] else f"fps={fps}"]
+            scale_pad = _scale_pad_filter(width, height, cuda_frames, pr)
+            v_chains[key] = ",".join(steps + ([scale_pad] if scale_pad else []))
+        filter_lines.append(f"[{idx}:v]{v_chains[key]}[{vlab}]")
+        # Audio longer than the video would push every later clip's audio behind its video
+        trim = f"atrim=0:{durations[idx]:.6f}" if pr["duration"] > durations[idx] else None
+        if audio_flags[idx] and _is_stereo_48k(pr):
+            # Already in the target format; anull still gives it a named pad, which -map needs
+            # when the graph has no joins
+            filter_lines.append(f"[{idx}:a]{trim or 'anull'}[{alab}]")
+        elif audio_flags[idx]:
+            filter_lines.append(f"[{idx}:a]{_AUDIO_NORM}{',' + trim if trim else ''}[{alab}]")
+        else:
+            # If no audio on this clip, synthesize silence for its full duration
+            filter_lines.append(f"{_SILENCE},atrim=0:{durations[idx]:.6f},asetpts=N/SR/TB[{alab}]")
+        v_labels.append(vlab)
+        a_labels.append(alab)
+
+    # Chain xfade/acrossfade with per-join transition and duration
+    current_v, current_a = v_labels[0], a_labels[0]
+    cum = 0.0
+    prev_d_sum = 0.0  # running sum of the transition durations of earlier joins
+    for k in range(1, len(input_files)):
+        prev_dur = durations[k-1]
+        cum += prev_dur
+
+        trans = str(transitions_norm[k-1])
+        d = float(durations_norm[k-1])
+
+        # offset_k = sum(dur[0..k-1]) - sum(d_i for i in 0..k-1)
+        # Since we allow per-join durations, subtract the sum of previous d's
+        offset = cum - prev_d_sum - d
+        prev_d_sum += d
+
+        next_v, next_a = v_labels[k], a_labels[k]
+        out_v, out_a = f"v{k}o", f"a{k}o"
+
+        filter_lines.append(
+            f"[{current_v}][{next_v}]xfade=transition={trans}:duration={d}:offset={offset:.6f}[{out_v}]"
+        )
+        filter_lines.append(
+            f"[{current_a}][{next_a}]acrossfade=d={d}[{out_a}]"
+        )
+
+        current_v, current_a = out_v, out_a
+
+    upload = _hw_upload_filter(encoder)
+    if upload:
+        filter_lines.append(f"[{current_v}]{upload}[venc]")
+        current_v = "venc"
+
+    # One chain per line keeps the graph file readable and diffable
+    filter_complex = ";\n".join(filter_lines)
+    graph_path = f"{os.path.splitext(output_path)[0]}_graph.txt"
+    with open(graph_path, "w") as f:
+        f.write(filter_complex)
+
+    # Execute via subprocess to map labeled pads safely
+    try:
+        _run_ffmpeg(
+            _transition_cmd(input_files, graph_path, current_v, current_a, output_path, encoder, cuda_frames, gpu,
+                            fragmented=fragmented, video_args=video_args),
+            sum(durations) - sum(durations_norm), progress_callback
+        )
+    finally:
+        os.remove(graph_path)
+
+# Transition renders with more inputs than this are split into chunks rendered in parallel
+_TRANSITION_CHUNK = 8
+
+def _render_chunked(input_files, probes, transitions_norm, durations_norm,
+                    output_path, width, height, fps, encoder, progress_callback=None, fragmented=False,
+                    boundary_transition=True):
+    """
+    Render input_files in chunks of _TRANSITION_CHUNK clips (one ffmpeg process each,
+    run concurrently) and join the intermediates into output_path. A single clip left
+    over at the end joins the last chunk instead of becoming a chunk of its own.
+    - boundary_transition=True: the joins between chunks get their transitions from
+      _render_smart, which re-encodes only the window around each join and copies the
+      rest of the intermediates (they are keyed at the join times for it). If the
+      intermediates can't be cut there, the joins fall back to a second xfade pass
+      over the whole output.
+    - boundary_transition=False: the intermediates are concatenated with -c copy and
+      the transitions at chunk boundaries are dropped.
+    Only the final output is written as fragmented MP4 when fragmented=True.
+    """
+    base = os.path.splitext(output_path)[0]
+    starts = list(range(0, len(input_files), _TRANSITION_CHUNK))
+    if len(starts) > 1 and len(input_files) - starts[-1] == 1:
+        starts.pop()
+    ends = starts[1:] + [len(input_files)]
+    parts = [f"{base}_part{i}.mp4" for i in range(len(starts))]
+    lengths = [sum(_video_duration(pr) for pr in probes[s:e]) - sum(durations_norm[s:e - 1]) for s, e in zip(starts, ends)]
+    joins = [s - 1 for s in starts[1:]]
+
+    # First pass maps to 0-100% (copy join) or 0-90% (the joins re-encode a window each)
+    first_share = 90 if boundary_transition and joins else 100
+    part_percent = [0] * len(parts)
+    progress_lock = threading.Lock()
+
+    def report(i, percent):
+        with progress_lock:
+            part_percent[i] = percent
+            progress_callback(int(sum(p * l for p, l in zip(part_percent, lengths)) / sum(lengths) * first_share / 100))
+
+    def boundary_keys(i):
+        # Keyframes where _smart_cuts will look for them: just after the incoming join's
+        # transition and just before the outgoing one's (a frame earlier, the part may end a frame early)
+        times = []
+        if i > 0:
+            times.append(math.ceil((durations_norm[joins[i - 1]] + _CUT_MARGIN) * fps) / fps)
+        if i < len(parts) - 1:
+            times.append(max(math.floor((lengths[i] - durations_norm[joins[i]] - _CUT_MARGIN) * fps) - 1, 0) / fps)
+        if not times:
+            return ()
+        args = ["-force_key_frames", ",".join(f"{t:.6f}" for t in times)]
+        # NVENC forces plain I frames otherwise, which the segmenter can't cut on
+        return args + (["-forced-idr", "1"] if encoder == "nvenc" else [])
+
+    def render_part(i):
+        s, e = starts[i], ends[i]
+        _render_transitions(
+            input_files[s:e], probes[s:e], transitions_norm[s:e - 1], durations_norm[s:e - 1],
+            parts[i], width, height, fps, encoder,
+            functools.partial(report, i) if progress_callback else None,
+            video_args=boundary_keys(i) if boundary_transition else ()
+        )
+        return _probe_file(parts[i])
 
-def _has_audio_stream(path):
-    """Return True if the media file contains at least one audio stream."""
+    try:
+        with ThreadPoolExecutor(max_workers=len(parts)) as ex:
+            part_probes = list(ex.map(render_part, range(len(parts))))
+
+        if boundary_transition and joins:
+            join_transitions = [transitions_norm[j] for j in joins]
+            join_durations = [durations_norm[j] for j in joins]
+            join_progress = (
+                (lambda percent: progress_callback(first_share + percent * (100 - first_share) // 100))
+                if progress_callback else None
+            )
+            cuts = _smart_cuts(parts, part_probes, join_durations, width, height, fps)
+            if cuts is not None:
+                _render_smart(parts, part_probes, join_transitions, join_durations,
+                              output_path, width, height, fps, encoder, join_progress, fragmented, cuts=cuts)
+            else:
+                print("Chunk intermediates can't be cut at the joins, re-encoding them to add the transitions")
+                _render_transitions(parts, part_probes, join_transitions, join_durations,
+                                    output_path, width, height, fps, encoder, join_progress, fragmented)
+        else:
+            _concat_copy(parts, output_path, _FRAGMENTED_MOVFLAGS if fragmented else ["-movflags", "+faststart"])
+    finally:
+        _remove_in_background(parts)
+
+# H.264 profile_idc -> the libx264 -profile:v that encodes to it (x264's baseline is Constrained Baseline)
+_X264_PROFILES = {66: "baseline", 77: "main", 100: "high"}
+
+def _x264_level_args(avc_level):
+    """
+    libx264 arguments encoding to the (profile_idc, constraint flags, level_idc) from
+    _mp4_avc_level, or None when libx264 can't (other profiles, level 1b and below).
+    """
+    if avc_level is None:
+        return None
+    profile_idc, flags, level_idc = avc_level
+    # Level 1b is level_idc 11 with constraint_set3 in Baseline/Main
+    if profile_idc not in _X264_PROFILES or level_idc < 10 or (level_idc == 11 and flags & 0x10):
+        return None
+    return ["-profile:v", _X264_PROFILES[profile_idc], "-level:v", f"{level_idc // 10}.{level_idc % 10}"]
+
+# Minimum seconds between a smart-render cut and the transition it borders: the segmenter
+# splits audio on whole AAC frames, so a window cut exactly at the transition can come out
+# with less audio than acrossfade needs
+_CUT_MARGIN = 0.1
+
+def _smart_cuts(input_files, probes, durations_norm, width, height, fps):
+    """
+    Keyframe-aligned (start, end) per clip for _render_smart: the span of the clip
+    outside its transition windows that can be stream-copied into the output.
+    Returns None when the clips can't be copied into the output as they are (not
+    H.264/AAC stereo 48 kHz at the target size, fps and square pixels, unrotated,
+    all of one H.264 profile and level libx264 can encode to) or a clip has no
+    keyframe-aligned middle left between its transitions.
+    """
+    for pr in probes:
+        # A copied stream keeps its coded size, so the clip must not be rotated on display
+        if (pr.get("video_codec") != "h264" or pr.get("pix_fmt") != "yuv420p"
+                or pr.get("rotation") != 0 or (pr.get("width"), pr.get("height")) != (width, height)
+                or not _matches_fps(pr, fps) or pr.get("sar") not in (None, "1:1")
+                or pr.get("audio_codec") != "aac" or not _is_stereo_48k(pr)):
+            return None
+    # The output's stream configuration (avcC) is the first clip's, so every copied clip and
+    # every window encoded for them must conform to its profile and level
+    levels = {_mp4_avc_level(p) for p in input_files}
+    if len(levels) != 1 or _x264_level_args(levels.pop()) is None:
+        return None
+
+    with ThreadPoolExecutor(max_workers=min(16, len(input_files))) as ex:
+        keyframes = list(ex.map(_keyframe_times, input_files))
+
+    cuts = []
+    last = len(input_files) - 1
+    for i, (keys, pr) in enumerate(zip(keyframes, probes)):
+        # The copied span starts on the first keyframe after the incoming transition and
+        # ends on the last keyframe before the outgoing one (both ends of the clip are copied as-is)
+        start = 0.0 if i == 0 else next((t for t in keys if t >= durations_norm[i-1] + _CUT_MARGIN), None)
+        end = _video_duration(pr) if i == last else next(
+            (t for t in reversed(keys) if t <= _video_duration(pr) - durations_norm[i] - _CUT_MARGIN), None
+        )
+        if start is None or end is None or end <= start:
+            return None
+        cuts.append((start, end))
+    return cuts
+
+def _stream_spans(path):
+    """(video start, video end, audio start) of path's first video and audio streams, in seconds."""
     r = subprocess.run([
-        "ffprobe", "-v", "error",
-        "-select_streams", "a",
-        "-show_entries", "stream=index",
-        "-of", "csv=p=0", path
-    ], capture_output=True, text=True)
-    return bool(r.stdout.strip())
-
-def _normalize_list(value, target_len):
+        "ffprobe", "-v", "error", "-show_entries", "stream=codec_type,start_time,duration", "-of", "json", path
+    ], capture_output=True, text=True, check=True)
+    streams = json.loads(r.stdout)["streams"]
+    video = next(st for st in streams if st["codec_type"] == "video")
+    audio = next(st for st in streams if st["codec_type"] == "audio")
+    v_start = float(video["start_time"])
+    return v_start, v_start + float(video["duration"]), float(audio["start_time"])
+
+def _render_smart(input_files, probes, transitions_norm, durations_norm,
+                  output_path, width, height, fps, encoder, progress_callback=None, fragmented=False,
+                  cuts=None):
     """
-    Normalize a parameter that can be either a scalar or a list to a list of length target_len.
-    - If scalar: replicate it.
-    - If list shorter: pad with its last value.
-    - If list longer: truncate.
+    Re-encode only the transition windows and stream-copy everything between them.
+    Each clip is split with -c copy on the keyframes in cuts (from _smart_cuts); the
+    tail of clip k and the head of clip k+1 are joined by _render_transitions, and
+    the copied middles and rendered windows are concatenated with -c copy (the video;
+    audio is re-encoded in the same pass, see below).
+    The windows are short, so they are encoded with libx264 (whatever encoder is),
+    pinned to the clips' H.264 profile and level. Their parameter sets still differ
+    from the clips', so the output is tagged avc3, which carries parameter sets in
+    band where avc1 would only allow the first clip's.
     """
-    if isinstance(value, (str, float, int)):
-        return [value] * target_len
-    if not isinstance(value, (list, tuple)):
-        raise ValueError("Parameter must be a scalar or a list/tuple.")
-    lst = list(value)
-    if len(lst) < target_len:
-        lst += [lst[-1]] * (target_len - len(lst))
-    return lst[:target_len]
+    base = os.path.splitext(output_path)[0]
+    last = len(input_files) - 1
+    window_args = _x264_level_args(_mp4_avc_level(input_files[0]))
+
+    def split(i):
+        times = [t for t, keep in ((cuts[i][0], i > 0), (cuts[i][1], i < last)) if keep]
+        pattern = f"{base}_clip{i}_%d.mp4"
+        # Requested times sit just before the keyframes, so the segmenter splits exactly on them
+        subprocess.run([
+            "ffmpeg", "-y", "-v", "error", "-i", input_files[i], "-map", "0:v:0", "-map", "0:a:0",
+            "-c", "copy", "-f", "segment", "-segment_format", "mp4", "-reset_timestamps", "1",
+            "-segment_times", ",".join(f"{max(t - 0.001, 0):.6f}" for t in times), pattern
+        ], check=True)
+        # (head, middle, tail); the first clip has no head and the last no tail
+        pieces = [pattern % n for n in range(len(times) + 1)]
+        return ([None] if i == 0 else []) + pieces + ([None] if i == last else [])
+
+    windows = [f"{base}_window{k}.mp4" for k in range(last)]
+    audio_graph = f"{base}_audio_graph.txt"
+    lengths = [_video_duration(probes[k]) - cuts[k][1] + cuts[k+1][0] - durations_norm[k] for k in range(last)]
+    window_percent = [0] * last
+    progress_lock = threading.Lock()
+
+    def report(k, percent):
+        with progress_lock:
+            window_percent[k] = percent
+            progress_callback(int(sum(p * l for p, l in zip(window_percent, lengths)) / sum(lengths)))
+
+    def render_window(k):
+        tail, head = pieces[k][2], pieces[k+1][0]
+        tail_probe = dict(probes[k], duration=probes[k]["duration"] - cuts[k][1],
+                          video_duration=_video_duration(probes[k]) - cuts[k][1])
+        head_probe = dict(probes[k+1], duration=cuts[k+1][0], video_duration=cuts[k+1][0])
+        _render_transitions(
+            [tail, head], [tail_probe, head_probe],
+            [transitions_norm[k]], [durations_norm[k]], windows[k], width, height, fps, None,
+            functools.partial(report, k) if progress_callback else None, video_args=window_args
+        )
+
+    pieces = []
+    try:
+        with ThreadPoolExecutor(max_workers=min(16, len(input_files))) as ex:
+            pieces = list(ex.map(split, range(len(input_files))))
+        with ThreadPoolExecutor(max_workers=last) as ex:
+            list(ex.map(render_window, range(last)))
+
+        # Middle of each clip, then the window joining it to the next one
+        order = [p for k, clip in enumerate(pieces) for p in [clip[1]] + windows[k:k + 1]]
+        with ThreadPoolExecutor(max_workers=min(16, len(order))) as ex:
+            spans = list(ex.map(_stream_spans, order))
+
+        # A copied piece keeps whole AAC frames, so its audio runs a little past its video and
+        # those overruns add up join after join. The video is still copied (each piece just for
+        # its video's span), but the audio is re-encoded in the same pass with every piece cut
+        # (or padded) to that span
+        with open(audio_graph, "w") as f:
+            f.write(";\n".join(
+                [f"[{i + 1}:a]atrim={v_start:.6f}:{v_end:.6f},asetpts=PTS-STARTPTS"
+                 + (f",adelay={(a_start - v_start) * 1000:.3f}:all=1" if a_start > v_start else "")
+                 + f",apad=whole_dur={v_end - v_start:.6f}[a{i}]"
+                 for i, (v_start, v_end, a_start) in enumerate(spans)]
+                + ["".join(f"[a{i}]" for i in range(len(order))) + f"concat=n={len(order)}:v=0:a=1[aout]"]
+            ))
+        _concat_copy(
+            order, output_path,
+            ["-/filter_complex", audio_graph, "-map", "0:v:0", "-map", "[aout]", "-c:a", "aac", "-tag:v", "avc3",
+             *(_FRAGMENTED_MOVFLAGS if fragmented else ["-movflags", "+faststart"])],
+            spans=[(v_start, v_end) for v_start, v_end, _ in spans],
+            input_args=[arg for p in order for arg in ("-i", p)]
+        )
+    finally:
+        _remove_in_background([p for clip in pieces for p in clip if p] + windows + [audio_graph])
 
 # Set the default local storage directory
 STORAGE_PATH = "/tmp/"
@@ -100,7 +461,13 @@ def process_video_combination(
     use_transitions=False,
     transitions="fade",                 # str or list[str] of length (N-1)
     transition_durations=1.0,           # float or list[float] of length (N-1)
-    width=1280, height=720, fps=30      # normalization when transitions are enabled
+    width=1280, height=720, fps=30,     # normalization when transitions are enabled
+    hw_accel="auto",                    # "auto" (hardware encoder when available) or "none" (libx264)
+    stream_inputs=False,                # transition mode: let ffmpeg read the URLs directly
+    progress_callback=None,             # transition mode: called with percent encoded
+    boundary_transition=True,           # transition mode, > 8 clips: keep transitions between chunks
+    fragmented_output=False,            # transition mode: write fragmented MP4 (uploadable while encoding)
+    smart_render=False                  # transition mode: re-encode only the transition windows
 ):
     """
     Combine multiple videos into one.
@@ -112,127 +479,80 @@ def process_video_combination(
                    (e.g., ["fade", "wipeleft", "circleopen"]).
     - transition_durations: single float (e.g., 1.0) or list per join
                             (e.g., [0.75, 1.0, 1.25]).
+    - hw_accel: "auto" encodes on NVENC (decoding on NVDEC), QSV, VAAPI or VideoToolbox,
+                the first one ffmpeg and the host support, and falls back to libx264
+                otherwise (still decoding on hardware where ffmpeg finds any);
+                "none" decodes and encodes in software.
+    - stream_inputs: in transition mode, pass the URLs straight to ffmpeg instead of
+                     downloading them first (the copy paths always download, since the
+                     concat demuxer needs seekable local files).
+    - progress_callback: called with the whole percent of the output encoded so far
+                         while a transition render runs.
+    - boundary_transition: more than 8 clips are rendered in parallel chunks of 8; True
+                           keeps the transitions between chunks (re-encoding only the
+                           window around each one), False joins the chunks with -c copy
+                           (no transition there).
+    - fragmented_output: in transition mode, write a fragmented MP4 front to back so it
+                         can be uploaded while it is encoded (see StreamingUpload).
+    - smart_render: in transition mode, when the downloaded clips are already H.264/AAC
+                    in the target format, stream-copy each clip between its transitions
+                    and re-encode only the transition windows (cut on keyframes, so a
+                    window spans up to a GOP more than the transition). Falls back to a
+                    full render when the clips don't qualify.
     """
     input_files = []
     output_filename = f"{job_id}.mp4"
     output_path = os.path.join(STORAGE_PATH, output_filename)
+    streamed = use_transitions and stream_inputs
 
     try:
-        # 1) Download all media files
-        for i, media_item in enumerate(media_urls):
-            url = media_item['video_url']
-            input_filename = download_file(url, os.path.join(STORAGE_PATH, f"{job_id}_input_{i}"))
-            input_files.append(input_filename)
+        if streamed:
+            # 1) Re-encoding anyway: ffmpeg fetches the URLs itself, nothing is staged on disk
+            input_files = [m['video_url'] for m in media_urls]
+            probes = _probe_urls(input_files)
+        else:
+            # 1) Download all media files (in parallel, order preserved)
+            input_files, probes = _download_inputs(
+                media_urls, job_id, STORAGE_PATH, _probe_cached if use_transitions else None
+            )
 
         # Fast path: single file + no transitions
         if len(input_files) == 1 and not use_transitions:
-            (
-                ffmpeg
-                .input(input_files[0])
-                .output(output_path, c='copy')
-                .overwrite_output()
-                .run(capture_stdout=True, capture_stderr=True)
+            # Only errors reach stderr, so the captured stderr stays small
+            subprocess.run(
+                ["ffmpeg", "-y", "-loglevel", "error", "-i", input_files[0], "-c", "copy", output_path],
+                check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
             )
         elif not use_transitions:
             # 2) Fast concat using concat demuxer
-            concat_file_path = os.path.join(STORAGE_PATH, f"{job_id}_concat_list.txt")
-            with open(concat_file_path, 'w') as concat_file:
-                for input_file in input_files:
-                    concat_file.write(f"file '{os.path.abspath(input_file)}'\n")
-
-            (
-                ffmpeg
-                .input(concat_file_path, format='concat', safe=0)
-                .output(output_path, c='copy')
-                .overwrite_output()
-                .run(capture_stdout=True, capture_stderr=True)
-            )
-            os.remove(concat_file_path)
+            _concat_copy(input_files, output_path)
 
         else:
             # 3) Transition mode: build filter_complex with xfade + acrossfade
             if len(input_files) < 2:
                 raise ValueError("At least two inputs are required for transitions.")
 
-            # Read durations and audio presence for each input
-            durations = [_probe_duration(p) for p in input_files]
-            audio_flags = [_has_audio_stream(p) for p in input_files]
-
             # Normalize transitions and durations to (N-1) items
             joins = len(input_files) - 1
             transitions_norm = _normalize_list(transitions, joins)
             durations_norm = [float(x) for x in _normalize_list(transition_durations, joins)]
 
-            filter_lines = []
-            v_labels, a_labels = [], []
-
-            # Normalize each input (scale, fps, audio)
-            for idx, _ in enumerate(input_files):
-                vlab = f"v{idx}"
-                alab = f"a{idx}"
-                filter_lines.append(
-                    f"[{idx}:v]fps={fps},scale={width}:{height}:force_original_aspect_ratio=decrease,"
-                    f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,format=yuv420p[{vlab}]"
-                )
-                if audio_flags[idx]:
-                    filter_lines.append(f"[{idx}:a]aformat=channel_layouts=stereo,aresample=48000[{alab}]")
-                else:
-                    # If no audio on this clip, synthesize silence for its full duration
-                    filter_lines.append(
-                        f"anullsrc=channel_layout=stereo:sample_rate=48000,atrim=0:{durations[idx]:.6f},asetpts=N/SR/TB[{alab}]"
-                    )
-                v_labels.append(vlab)
-                a_labels.append(alab)
-
-            # Chain xfade/acrossfade with per-join transition and duration
-            current_v, current_a = v_labels[0], a_labels[0]
-            cum = 0.0
-            for k in range(1, len(input_files)):
-                prev_dur = durations[k-1]
-                cum += prev_dur
-
-                trans = str(transitions_norm[k-1])
-                d = float(durations_norm[k-1])
-
-                # offset_k = sum(dur[0..k-1]) - sum(d_i for i in 0..k-1)
-                # Since we allow per-join durations, subtract the sum of previous d's
-                prev_d_sum = sum(durations_norm[:k-1]) if k > 1 else 0.0
-                offset = cum - prev_d_sum - d
-
-                next_v, next_a = v_labels[k], a_labels[k]
-                out_v, out_a = f"v{k}o", f"a{k}o"
-
-                filter_lines.append(
-                    f"[{current_v}][{next_v}]xfade=transition={trans}:duration={d}:offset={offset:.6f}[{out_v}]"
-                )
-                filter_lines.append(
-                    f"[{current_a}][{next_a}]acrossfade=d={d}[{out_a}]"
-                )
-
-                current_v, current_a = out_v, out_a
-
-            filter_complex = "; ".join(filter_lines)
-
-            # Execute via subprocess to map labeled pads safely
-            cmd = ["ffmpeg", "-y"]
-            for p in input_files:
-                cmd += ["-i", p]
-            cmd += [
-                "-filter_complex", filter_complex,
-                "-map", f"[{current_v}]",
-                "-map", f"[{current_a}]",
-                "-c:v", "libx264", "-preset", "veryfast", "-crf", "18",
-                "-c:a", "aac", "-movflags", "+faststart",
-                output_path
-            ]
-            subprocess.run(cmd, check=True)
-
-        # 4) Cleanup input files
-        for f in input_files:
-            try:
-                os.remove(f)
-            except:
-                pass
+            render = _render_transitions
+            cuts = None
+            if smart_render and not streamed:
+                cuts = _smart_cuts(input_files, probes, durations_norm, width, height, fps)
+            if cuts is not None:
+                render = functools.partial(_render_smart, cuts=cuts)
+            elif len(input_files) > _TRANSITION_CHUNK:
+                render = functools.partial(_render_chunked, boundary_transition=boundary_transition)
+
+            _render_with_fallback(
+                lambda encoder: render(
+                    input_files, probes, transitions_norm, durations_norm,
+                    output_path, width, height, fps, encoder, progress_callback, fragmented_output
+                ),
+                _hw_encoder(hw_accel, width, height), output_path
+            )
 
         print(f"Video combination successful: {output_path}")
 
@@ -243,4 +563,10 @@ def process_video_combination(
 
     except Exception as e:
         print(f"Video combination failed: {e}")
-        raise
\ No newline at end of file
+        raise
+
+    finally:
+        # 4) Cleanup input files, also after a failure (streamed inputs were never written
+        # locally; cached ones are shared and only released)
+        if not streamed:
+            _release_inputs(input_files, STORAGE_PATH)
\ No newline at end of file
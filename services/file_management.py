@@ -17,10 +17,36 @@
 
 
 import os
+import time
 import uuid
+import fcntl
+import hashlib
+import threading
 import requests
 from urllib.parse import urlparse, parse_qs
 import mimetypes
+from requests.adapters import HTTPAdapter
+
+# Shared across downloads (and the worker threads that run them) so repeated requests
+# to the same host reuse pooled TCP/TLS connections
+_MAX_PARALLEL_DOWNLOADS = 16
+_session = requests.Session()
+_session.mount('http://', HTTPAdapter(pool_maxsize=_MAX_PARALLEL_DOWNLOADS))
+_session.mount('https://', HTTPAdapter(pool_maxsize=_MAX_PARALLEL_DOWNLOADS))
+
+# Cached downloads in use by this process's jobs: path -> descriptors holding a shared flock on
+# the file, one per download_file_cached call. Eviction (in any worker process) skips files it
+# can't lock exclusively, so a job's inputs stay on disk until it calls release_cached_download.
+_cache_leases = {}
+_cache_leases_lock = threading.Lock()
+
+# Fresh cache downloads are written to this subdirectory of the cache and published from it.
+# A partial file untouched for _ABANDONED_PARTIAL_SECONDS belongs to a killed worker and is removed
+_PARTIAL_DIR = '.partial'
+_ABANDONED_PARTIAL_SECONDS = 3600
+
+# Downloads are written in 1 MiB chunks: one read and one write syscall per MiB instead of per 8 KiB
+_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
 
 def get_extension_from_url(url):
     """Extract file extension from URL or content type.
@@ -44,7 +70,7 @@ def get_extension_from_url(url):
 
     # If no extension in URL, try to determine from content type
     try:
-        response = requests.head(url, allow_redirects=True)
+        response = _session.head(url, allow_redirects=True)
         content_type = response.headers.get('content-type', '').split(';')[0]
         ext = mimetypes.guess_extension(content_type)
         if ext:
@@ -55,21 +81,30 @@ def get_extension_from_url(url):
     # If we can't determine the extension, raise an error
     raise ValueError(f"Could not determine file extension from URL: {url}")
 
+def head_url(url):
+    """HEAD url over the shared session (following redirects); returns its headers, or {} if the request fails."""
+    try:
+        response = _session.head(url, timeout=5, allow_redirects=True)
+        response.raise_for_status()
+    except requests.RequestException:
+        return {}
+    return response.headers
+
 def download_file(url, storage_path="/tmp/"):
-    """Download a file from URL to local storage."""
+    """Download a file from URL to local storage. Returns the file's absolute path."""
     # Create storage directory if it doesn't exist
     os.makedirs(storage_path, exist_ok=True)
     
     file_id = str(uuid.uuid4())
     extension = get_extension_from_url(url)
-    local_filename = os.path.join(storage_path, f"{file_id}{extension}")
+    local_filename = os.path.join(os.path.abspath(storage_path), f"{file_id}{extension}")
 
     try:
-        response = requests.get(url, stream=True)
+        response = _session.get(url, stream=True)
         response.raise_for_status()
 
         with open(local_filename, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
+            for chunk in response.iter_content(chunk_size=_DOWNLOAD_CHUNK_SIZE):
                 if chunk:
                     f.write(chunk)
 
@@ -79,3 +114,174 @@ def download_file(url, storage_path="/tmp/"):
             os.remove(local_filename)
         raise e
 
+def download_file_cached(url, cache_dir, max_cache_bytes, headers=None):
+    """Download a file into a shared, size-capped cache directory, reusing a previous copy.
+
+    The cached copy is keyed by sha1(url) and reused when its size matches the
+    Content-Length the server reports now. After a fresh download the least recently
+    used entries are evicted until the cache fits in max_cache_bytes. Cached files
+    are shared between jobs and must not be deleted by callers; instead each returned
+    path is leased to the caller (protected from eviction) until it is passed to
+    release_cached_download.
+
+    Args:
+        url (str): The URL to download
+        cache_dir (str): Directory holding the cache
+        max_cache_bytes (int): Size cap for the cache directory (0 disables caching)
+        headers (Mapping, optional): Headers of an earlier HEAD request for url, to avoid a second one
+
+    Returns:
+        str or None: Absolute path of the cached file, or None when caching is disabled or the
+        server reports no Content-Length (callers should fall back to download_file)
+    """
+    if max_cache_bytes <= 0:
+        return None
+    if headers is None:
+        headers = head_url(url)
+    content_length = int(headers.get('Content-Length') or 0)
+    if not content_length:
+        return None
+
+    extension = os.path.splitext(urlparse(url).path)[1].lower()
+    cached_path = os.path.join(os.path.abspath(cache_dir), hashlib.sha1(url.encode()).hexdigest() + extension)
+    while True:
+        fd = _open_locked(cached_path, fcntl.LOCK_SH)
+        if fd is None:
+            break
+        if _is_current(fd, cached_path):
+            # Reuse the copy only if its size still matches what the server reports
+            if os.fstat(fd).st_size == content_length:
+                _add_lease(cached_path, fd)
+                os.utime(cached_path)  # mark as recently used
+                _prefetch(cached_path)
+                return cached_path
+            os.close(fd)
+            break
+        # Evicted or replaced while we waited for the lock: look again
+        os.close(fd)
+
+    # Jobs read their inputs by name, so a stale copy leased to another job must not be replaced
+    # under it; the caller downloads its own copy instead. Otherwise the stale copy stays locked
+    # (unleasable, unevictable) until the fresh one replaces it
+    stale_fd = _open_locked(cached_path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    if stale_fd is None and os.path.exists(cached_path):
+        return None
+    try:
+        # Download next to the entries (eviction counts partial files but never mistakes them for
+        # entries), then publish atomically; the lease is taken before publishing, so the new file
+        # is never evictable
+        partial_path = download_file(url, os.path.join(cache_dir, _PARTIAL_DIR))
+        fd = None
+        try:
+            fd = _open_locked(partial_path, fcntl.LOCK_SH)
+            if stale_fd is not None:
+                os.replace(partial_path, cached_path)
+            else:
+                # Another job may have published the same URL meanwhile (and be reading it):
+                # link fails instead of replacing that copy
+                os.link(partial_path, cached_path)
+                os.remove(partial_path)
+        except FileExistsError:
+            os.close(fd)
+            os.remove(partial_path)
+            return download_file_cached(url, cache_dir, max_cache_bytes, headers)
+        except BaseException:
+            if fd is not None:
+                os.close(fd)
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+    finally:
+        if stale_fd is not None:
+            os.close(stale_fd)
+    _add_lease(cached_path, fd)
+    _evict_download_cache(cache_dir, max_cache_bytes)
+    return cached_path
+
+def release_cached_download(path):
+    """Drop one lease download_file_cached took on path, so the cache may evict it again."""
+    with _cache_leases_lock:
+        fds = _cache_leases.get(path)
+        if not fds:
+            return
+        fd = fds.pop()
+        if not fds:
+            del _cache_leases[path]
+    os.close(fd)
+
+def _add_lease(path, fd):
+    """Record fd (holding a shared flock on path) as one lease on path."""
+    with _cache_leases_lock:
+        _cache_leases.setdefault(path, []).append(fd)
+
+def _open_locked(path, operation):
+    """Open path read-only and flock it (operation: LOCK_SH or LOCK_EX|LOCK_NB); None if missing or locked."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(fd, operation)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+def _is_current(fd, path):
+    """True if fd is still the file named path (it wasn't removed or replaced since it was opened)."""
+    try:
+        return os.fstat(fd).st_ino == os.stat(path).st_ino
+    except FileNotFoundError:
+        return False
+
+def _prefetch(path):
+    """
+    Start reading path into the page cache in the background (POSIX_FADV_WILLNEED), so a
+    cached copy that was evicted from memory is already being read while it is probed.
+    No-op where posix_fadvise is unavailable.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+def _evict_download_cache(cache_dir, max_cache_bytes):
+    """
+    Remove least recently used files from cache_dir until it fits in max_cache_bytes.
+    Files leased to a running job (in any process) are skipped. Downloads still in
+    progress count toward the size; abandoned ones are removed.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file():
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    partial_dir = os.path.join(cache_dir, _PARTIAL_DIR)
+    if os.path.isdir(partial_dir):
+        for entry in os.scandir(partial_dir):
+            try:
+                stat = entry.stat()
+                if time.time() - stat.st_mtime > _ABANDONED_PARTIAL_SECONDS:
+                    os.remove(entry.path)
+                else:
+                    total += stat.st_size
+            except FileNotFoundError:
+                pass
+    for _, size, path in sorted(entries):
+        if total <= max_cache_bytes:
+            break
+        fd = _open_locked(path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if fd is None:
+            continue
+        try:
+            if _is_current(fd, path):
+                os.remove(path)
+                total -= size
+        except FileNotFoundError:
+            pass
+        finally:
+            os.close(fd)
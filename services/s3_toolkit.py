@@ -26,7 +26,12 @@ logger = logging.getLogger(__name__)
 def upload_to_s3(file_path, s3_url, access_key, secret_key, bucket_name, region):
     # Parse the S3 URL into bucket, region, and endpoint
     #bucket_name, region, endpoint_url = parse_s3_url(s3_url)
-    
+
+    with open(file_path, 'rb') as data:
+        return upload_fileobj_to_s3(data, os.path.basename(file_path), s3_url, access_key, secret_key, bucket_name, region)
+
+def upload_fileobj_to_s3(fileobj, file_name, s3_url, access_key, secret_key, bucket_name, region):
+    """Upload a readable file object (seekable or not) to the bucket as file_name and return its public URL."""
     session = boto3.Session(
         aws_access_key_id=access_key,
         aws_secret_access_key=secret_key,
@@ -36,12 +41,11 @@ def upload_to_s3(file_path, s3_url, access_key, secret_key, bucket_name, region)
     client = session.client('s3', endpoint_url=s3_url)
 
     try:
-        # Upload the file to the specified S3 bucket
-        with open(file_path, 'rb') as data:
-            client.upload_fileobj(data, bucket_name, os.path.basename(file_path), ExtraArgs={'ACL': 'public-read'})
+        # Upload the file to the specified S3 bucket (multipart, part by part, for streams)
+        client.upload_fileobj(fileobj, bucket_name, file_name, ExtraArgs={'ACL': 'public-read'})
 
         # URL encode the filename for the URL
-        encoded_filename = quote(os.path.basename(file_path))
+        encoded_filename = quote(file_name)
         file_url = f"{s3_url}/{bucket_name}/{encoded_filename}"
         return file_url
     except Exception as e:
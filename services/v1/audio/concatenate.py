@@ -34,12 +34,10 @@ def process_audio_concatenate(media_urls, job_id, webhook_url=None):
             input_filename = download_file(url, os.path.join(LOCAL_STORAGE_PATH, f"{job_id}_input_{i}"))
             input_files.append(input_filename)
 
-        # Generate an absolute path concat list file for FFmpeg
+        # Generate an absolute path concat list file for FFmpeg (download_file returns absolute paths)
         concat_file_path = os.path.join(LOCAL_STORAGE_PATH, f"{job_id}_concat_list.txt")
         with open(concat_file_path, 'w') as concat_file:
-            for input_file in input_files:
-                # Write absolute paths to the concat list
-                concat_file.write(f"file '{os.path.abspath(input_file)}'\n")
+            concat_file.write("".join(f"file '{input_file}'\n" for input_file in input_files))
 
         # Use the concat demuxer to concatenate the audio files without re-encoding
         (
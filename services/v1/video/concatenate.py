@@ -17,51 +17,127 @@
 
 
 import os
-import json
 import subprocess
-import ffmpeg
 import requests
-from services.file_management import download_file
+from services._ffmpeg_common import (
+    _probe_file_cached, _display_size, _is_stereo_48k, _hw_encoder, _hw_upload_filter, _npp_available, _next_gpu,
+    _scale_pad_filter, _transition_cmd, _run_ffmpeg, _concat_copy, _normalize_list,
+    _download_inputs, _release_inputs, _render_with_fallback
+)
 from config import LOCAL_STORAGE_PATH
 
 
 # --- Helpers ---------------------------------------------------------------
 
-def _probe_duration(path):
-    """Get media duration in seconds using ffprobe (format duration)."""
-    r = subprocess.run([
-        "ffprobe", "-v", "error",
-        "-show_entries", "format=duration",
-        "-of", "json", path
-    ], capture_output=True, text=True, check=True)
-    data = json.loads(r.stdout)
-    return float(data["format"]["duration"])
-
-def _has_audio_stream(path):
-    """Return True if the media file contains at least one audio stream."""
-    r = subprocess.run([
-        "ffprobe", "-v", "error",
-        "-select_streams", "a",
-        "-show_entries", "stream=index",
-        "-of", "csv=p=0", path
-    ], capture_output=True, text=True)
-    return bool(r.stdout.strip())
-
-def _normalize_list(value, target_len):
-    """
-    Normalize a parameter that can be either a scalar or a list to a list of length target_len.
-    - If scalar: replicate it.
-    - If list shorter: pad with its last value.
-    - If list longer: truncate.
-    """
-    if isinstance(value, (str, float, int)):
-        return [value] * target_len
-    if not isinstance(value, (list, tuple)):
-        raise ValueError("Parameter must be a scalar or a list/tuple.")
-    lst = list(value)
-    if len(lst) < target_len:
-        lst += [lst[-1]] * (target_len - len(lst))
-    return lst[:target_len]
+def _probe_download(url, path, headers):
+    """Probe a downloaded input for _download_inputs (by content fingerprint, so cached copies skip ffprobe)."""
+    return _probe_file_cached(path)
+
+# Fixed audio filter pieces of the transition graph. Clips already in stereo 48 kHz only
+# need their timestamps reset; the others are converted and resynced.
+_AUDIO_RESET = "asetpts=PTS-STARTPTS"
+_AUDIO_RESYNC = f"{_AUDIO_RESET},aformat=channel_layouts=stereo,aresample=48000:async=1:first_pts=0"
+_SILENCE = "anullsrc=channel_layout=stereo:sample_rate=48000"
+
+def _render_transitions(input_files, probes, transitions_norm, d_norm, prepad,
+                        output_path, width, height, fps, pad_color, encoder, progress_callback=None):
+    """Build the xfade/acrossfade filter graph (with per-clip lead-ins) and encode it to output_path."""
+    # Keep frames on the GPU through the scale step when NVENC and scale_npp are both available
+    cuda_frames = encoder == "nvenc" and _npp_available()
+    # Pin decode + encode of this job to one GPU so concurrent jobs spread across all of them
+    gpu = _next_gpu() if encoder == "nvenc" else None
+    durations = [pr["duration"] for pr in probes]
+    audio_flags = [pr["has_audio"] for pr in probes]
+
+    filter_lines = []
+    v_labels, a_labels = [], []
+
+    # The normalization part of the video chain only varies with the clip's format,
+    # so it is built once per distinct (width, height, rotation, pix_fmt, sar)
+    v_chains = {}
+    for idx, pr in enumerate(probes):
+        vlab = f"v{idx}"
+        alab = f"a{idx}"
+
+        # --- Reset PTS first, then normalize, then optional lead-in on video ---
+        # Steps the clip already satisfies (scale, pad, setsar, format) are left out. fps
+        # always stays: setpts drops the link's frame rate, which xfade requires.
+        # tpad runs last, so its lead-in frames are generated at the target size and
+        # format and never pass through scale/pad (unlike a lavfi color input + concat,
+        # which would also need its own fps/format matching)
+        key = (*_display_size(pr), pr.get("pix_fmt"), pr.get("sar"))
+        if key not in v_chains:
+            scale_pad = _scale_pad_filter(width, height, cuda_frames, pr)
+            v_chains[key] = f"setpts=PTS-STARTPTS,fps={fps}" + (f",{scale_pad}" if scale_pad else "")
+        if prepad[idx] > 0:
+            filter_lines.append(f"[{idx}:v]{v_chains[key]},tpad=start_duration={prepad[idx]}:color={pad_color}[{vlab}]")
+        else:
+            filter_lines.append(f"[{idx}:v]{v_chains[key]}[{vlab}]")
+
+        # --- Audio: reset PTS, stereo+48k + resync unless already so, optional lead-in via adelay ---
+        if audio_flags[idx]:
+            a_chain = _AUDIO_RESET if _is_stereo_48k(pr) else _AUDIO_RESYNC
+            if prepad[idx] > 0:
+                ms = int(round(prepad[idx] * 1000))
+                filter_lines.append(f"[{idx}:a]{a_chain},adelay={ms}|{ms}[{alab}]")
+            else:
+                filter_lines.append(f"[{idx}:a]{a_chain}[{alab}]")
+        else:
+            # Synthesize silence for (duration + lead-in) if clip has no audio
+            total_sil = durations[idx] + prepad[idx]
+            filter_lines.append(f"{_SILENCE},atrim=0:{total_sil:.6f},asetpts=PTS-STARTPTS[{alab}]")
+
+        v_labels.append(vlab)
+        a_labels.append(alab)
+
+    # --- Chain xfade/acrossfade with iterative offsets to avoid freezing ---
+    current_v, current_a = v_labels[0], a_labels[0]
+    current_len = durations[0]  # current composed timeline length after first clip (no prepad on clip 0)
+
+    for k in range(1, len(input_files)):
+        trans = str(transitions_norm[k-1])
+        d_k = float(d_norm[k-1])
+        prepad_k = prepad[k]
+
+        # Start xfade so that it ends exactly at the boundary of the previous composed timeline
+        offset = max(current_len - d_k, 0.0)
+
+        next_v, next_a = v_labels[k], a_labels[k]
+        out_v, out_a = f"v{k}o", f"a{k}o"
+
+        filter_lines.append(
+            f"[{current_v}][{next_v}]xfade=transition={trans}:duration={d_k}:offset={offset:.6f}[{out_v}]"
+        )
+        filter_lines.append(
+            f"[{current_a}][{next_a}]acrossfade=d={d_k}[{out_a}]"
+        )
+
+        # Update composed length: add lead-in and clip k, subtract overlap d_k
+        current_len = current_len + prepad_k + durations[k] - d_k
+
+        current_v, current_a = out_v, out_a
+
+    upload = _hw_upload_filter(encoder)
+    if upload:
+        filter_lines.append(f"[{current_v}]{upload}[venc]")
+        current_v = "venc"
+
+    # One chain per line keeps the graph file readable and diffable
+    filter_complex = ";\n".join(filter_lines)
+    graph_path = f"{os.path.splitext(output_path)[0]}_graph.txt"
+    with open(graph_path, "w") as f:
+        f.write(filter_complex)
+
+    # Execute via subprocess to map labeled pads safely; genpts fills in missing input and
+    # output timestamps (the filters already start every clip at zero)
+    try:
+        _run_ffmpeg(
+            _transition_cmd(input_files, graph_path, current_v, current_a, output_path, encoder, cuda_frames, gpu,
+                            genpts=True),
+            current_len, progress_callback
+        )
+    finally:
+        os.remove(graph_path)
 
         
 def process_video_concatenate(
@@ -74,56 +150,46 @@ def process_video_concatenate(
     transition_durations=1.0,           # float or list[float] for each join
     width=1280, height=720, fps=30,
     preserve_clip_starts=True,          # <-- NEW: add lead-in equal to transition duration
-    pad_color="black"                   # color for the lead-in frames
+    pad_color="black",                  # color for the lead-in frames
+    hw_accel="auto",                    # "auto" (hardware encoder when available) or "none" (libx264)
+    progress_callback=None              # transition mode: called with percent encoded
 ):
     """
     Combine multiple videos. In transition mode:
     - Add a lead-in (video black + audio silence) to each clip except the first,
       equal to the corresponding transition duration, so speech at the start is preserved.
+    - Encode on NVENC (decoding on NVDEC), QSV, VAAPI or VideoToolbox when hw_accel="auto"
+      and ffmpeg and the host support one, falling back to libx264 otherwise (with
+      hardware decoding where ffmpeg finds any).
+    - Report the whole percent encoded so far to progress_callback, if given.
     """
     input_files = []
     output_filename = f"{job_id}.mp4"
     output_path = os.path.join(LOCAL_STORAGE_PATH, output_filename)
 
     try:
-        # 1) Download inputs
-        for i, media_item in enumerate(media_urls):
-            url = media_item['video_url']
-            input_filename = download_file(url, os.path.join(LOCAL_STORAGE_PATH, f"{job_id}_input_{i}"))
-            input_files.append(input_filename)
+        # 1) Download inputs (in parallel, order preserved)
+        input_files, probes = _download_inputs(
+            media_urls, job_id, LOCAL_STORAGE_PATH, _probe_download if use_transitions else None
+        )
 
         # Fast path
         if len(input_files) == 1 and not use_transitions:
-            (
-                ffmpeg.input(input_files[0])
-                .output(output_path, c='copy')
-                .overwrite_output()
-                .run(capture_stdout=True, capture_stderr=True)
+            # Only errors reach stderr, so the captured stderr stays small
+            subprocess.run(
+                ["ffmpeg", "-y", "-loglevel", "error", "-i", input_files[0], "-c", "copy", output_path],
+                check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
             )
 
         elif not use_transitions:
             # Concat demuxer (no re-encode)
-            concat_file_path = os.path.join(LOCAL_STORAGE_PATH, f"{job_id}_concat_list.txt")
-            with open(concat_file_path, 'w') as f:
-                for p in input_files:
-                    f.write(f"file '{os.path.abspath(p)}'\n")
-
-            (
-                ffmpeg.input(concat_file_path, format='concat', safe=0)
-                .output(output_path, c='copy')
-                .overwrite_output()
-                .run(capture_stdout=True, capture_stderr=True)
-            )
-            os.remove(concat_file_path)
+            _concat_copy(input_files, output_path)
 
         else:
             # Transition mode (re-encode)
             if len(input_files) < 2:
                 raise ValueError("At least two inputs are required for transitions.")
 
-            durations = [_probe_duration(p) for p in input_files]
-            audio_flags = [_has_audio_stream(p) for p in input_files]
-
             joins = len(input_files) - 1
             transitions_norm = _normalize_list(transitions, joins)
             d_norm = [float(x) for x in _normalize_list(transition_durations, joins)]
@@ -131,104 +197,13 @@ def process_video_concatenate(
             # Lead-in per clip (seconds): prepad[0]=0; prepad[i]=d_norm[i-1] if preserving starts
             prepad = ([0.0] + d_norm[:]) if preserve_clip_starts else [0.0] * len(input_files)
 
-            filter_lines = []
-            v_labels, a_labels = [], []
-
-            for idx, _ in enumerate(input_files):
-                vlab = f"v{idx}"
-                alab = f"a{idx}"
-
-                # --- Reset PTS first, then normalize, then optional lead-in on video ---
-                if preserve_clip_starts and prepad[idx] > 0:
-                    filter_lines.append(
-                        f"[{idx}:v]setpts=PTS-STARTPTS,"
-                        f"fps={fps},scale={width}:{height}:force_original_aspect_ratio=decrease,"
-                        f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,format=yuv420p,"
-                        f"tpad=start_duration={prepad[idx]}:color={pad_color}[{vlab}]"
-                    )
-                else:
-                    filter_lines.append(
-                        f"[{idx}:v]setpts=PTS-STARTPTS,"
-                        f"fps={fps},scale={width}:{height}:force_original_aspect_ratio=decrease,"
-                        f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,format=yuv420p[{vlab}]"
-                    )
-
-                # --- Audio: reset PTS, stereo+48k, resync, optional lead-in via adelay ---
-                if audio_flags[idx]:
-                    if preserve_clip_starts and prepad[idx] > 0:
-                        ms = int(round(prepad[idx] * 1000))
-                        filter_lines.append(
-                            f"[{idx}:a]asetpts=PTS-STARTPTS,"
-                            f"aformat=channel_layouts=stereo,aresample=48000:async=1:first_pts=0,"
-                            f"adelay={ms}|{ms}[{alab}]"
-                        )
-                    else:
-                        filter_lines.append(
-                            f"[{idx}:a]asetpts=PTS-STARTPTS,"
-                            f"aformat=channel_layouts=stereo,aresample=48000:async=1:first_pts=0[{alab}]"
-                        )
-                else:
-                    # Synthesize silence for (duration + lead-in) if clip has no audio
-                    total_sil = durations[idx] + (prepad[idx] if preserve_clip_starts else 0.0)
-                    filter_lines.append(
-                        f"anullsrc=channel_layout=stereo:sample_rate=48000,atrim=0:{total_sil:.6f},"
-                        f"asetpts=PTS-STARTPTS[{alab}]"
-                    )
-
-                v_labels.append(vlab)
-                a_labels.append(alab)
-
-            # --- Chain xfade/acrossfade with iterative offsets to avoid freezing ---
-            current_v, current_a = v_labels[0], a_labels[0]
-            current_len = durations[0]  # current composed timeline length after first clip (no prepad on clip 0)
-
-            for k in range(1, len(input_files)):
-                trans = str(transitions_norm[k-1])
-                d_k = float(d_norm[k-1])
-                prepad_k = prepad[k]
-
-                # Start xfade so that it ends exactly at the boundary of the previous composed timeline
-                offset = max(current_len - d_k, 0.0)
-
-                next_v, next_a = v_labels[k], a_labels[k]
-                out_v, out_a = f"v{k}o", f"a{k}o"
-
-                filter_lines.append(
-                    f"[{current_v}][{next_v}]xfade=transition={trans}:duration={d_k}:offset={offset:.6f}[{out_v}]"
-                )
-                filter_lines.append(
-                    f"[{current_a}][{next_a}]acrossfade=d={d_k}[{out_a}]"
-                )
-
-                # Update composed length: add lead-in and clip k, subtract overlap d_k
-                current_len = current_len + prepad_k + durations[k] - d_k
-
-                current_v, current_a = out_v, out_a
-
-            filter_complex = "; ".join(filter_lines)
-
-            # Execute via subprocess to map labeled pads safely, enable genpts for container safety
-            cmd = ["ffmpeg", "-y"]
-            for p in input_files:
-                cmd += ["-i", p]
-            cmd += [
-                "-filter_complex", filter_complex,
-                "-map", f"[{current_v}]",
-                "-map", f"[{current_a}]",
-                "-c:v", "libx264", "-preset", "veryfast", "-crf", "18",
-                "-c:a", "aac",
-                "-movflags", "+faststart",
-                "-fflags", "+genpts",
-                output_path
-            ]
-            subprocess.run(cmd, check=True)
-
-        # Cleanup
-        for f in input_files:
-            try:
-                os.remove(f)
-            except:
-                pass
+            _render_with_fallback(
+                lambda encoder: _render_transitions(
+                    input_files, probes, transitions_norm, d_norm, prepad,
+                    output_path, width, height, fps, pad_color, encoder, progress_callback
+                ),
+                _hw_encoder(hw_accel, width, height), output_path
+            )
 
         print(f"Video combination successful: {output_path}")
 
@@ -239,4 +214,8 @@ def process_video_concatenate(
 
     except Exception as e:
         print(f"Video combination failed: {e}")
-        raise
\ No newline at end of file
+        raise
+
+    finally:
+        # Cleanup, also after a failure (cached downloads are shared with later jobs and only released)
+        _release_inputs(input_files, LOCAL_STORAGE_PATH)
\ No newline at end of file
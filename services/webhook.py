@@ -18,14 +18,30 @@
 
 import requests
 import logging
+from urllib.parse import urlsplit
 
 logger = logging.getLogger(__name__)
 
+# Shared session: connections to a webhook host are kept open and reused across jobs
+_session = requests.Session()
+
+def prewarm_webhook(webhook_url):
+    """
+    Open (DNS + TCP + TLS) a pooled connection to the webhook's host ahead of
+    send_webhook, with a HEAD to the host root rather than the webhook itself.
+    Best effort: failures are ignored and send_webhook connects as usual.
+    """
+    parts = urlsplit(webhook_url)
+    try:
+        _session.head(f"{parts.scheme}://{parts.netloc}/", timeout=5)
+    except requests.RequestException:
+        pass
+
 def send_webhook(webhook_url, data):
     """Send a POST request to a webhook URL with the provided data."""
     try:
         logger.info(f"Attempting to send webhook to {webhook_url} with data: {data}")
-        response = requests.post(webhook_url, json=data)
+        response = _session.post(webhook_url, json=data)
         response.raise_for_status()
         logger.info(f"Webhook sent: {data}")
     except requests.RequestException as e:
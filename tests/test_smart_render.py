@@ -0,0 +1,63 @@
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+pytest.importorskip("ffmpeg")
+if shutil.which("ffmpeg") is None or shutil.which("ffprobe") is None:
+    pytest.skip("ffmpeg/ffprobe not on PATH", allow_module_level=True)
+
+os.environ.setdefault("API_KEY", "test")
+import config  # noqa: E402
+
+# services.ffmpeg_toolkit imports STORAGE_PATH from config, which only defines LOCAL_STORAGE_PATH
+config.STORAGE_PATH = getattr(config, "STORAGE_PATH", config.LOCAL_STORAGE_PATH)
+
+from services._ffmpeg_common import _probe_file  # noqa: E402
+from services.ffmpeg_toolkit import _render_smart, _smart_cuts  # noqa: E402
+
+FPS = 30
+CLIP_SECONDS = 6
+TRANSITION_SECONDS = 1.0
+
+
+def _make_clip(path, seconds, audio_seconds):
+    """H.264/AAC clip in smart render's target format, keyed every second, audio running past the video."""
+    subprocess.run([
+        "ffmpeg", "-y", "-v", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size=1280x720:rate={FPS}:duration={seconds}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={audio_seconds}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-profile:v", "baseline", "-pix_fmt", "yuv420p",
+        "-g", str(FPS), "-c:a", "aac", "-ac", "2", path
+    ], check=True)
+
+
+def _stream_durations(path):
+    r = subprocess.run([
+        "ffprobe", "-v", "error", "-count_frames", "-show_entries",
+        "stream=codec_type,duration,nb_read_frames", "-of", "json", path
+    ], capture_output=True, text=True, check=True)
+    return {s["codec_type"]: s for s in json.loads(r.stdout)["streams"]}
+
+
+def test_smart_render_keeps_audio_on_video_length(tmp_path):
+    clips = [str(tmp_path / f"clip{i}.mp4") for i in range(4)]
+    for clip in clips:
+        _make_clip(clip, CLIP_SECONDS, CLIP_SECONDS + 0.1)
+    probes = [_probe_file(clip) for clip in clips]
+    joins = len(clips) - 1
+    durations = [TRANSITION_SECONDS] * joins
+
+    cuts = _smart_cuts(clips, probes, durations, 1280, 720, FPS)
+    assert cuts is not None
+    output = str(tmp_path / "out.mp4")
+    _render_smart(clips, probes, ["fade"] * joins, durations, output, 1280, 720, FPS, None, cuts=cuts)
+
+    streams = _stream_durations(output)
+    expected = len(clips) * CLIP_SECONDS - joins * TRANSITION_SECONDS
+    assert int(streams["video"]["nb_read_frames"]) == round(expected * FPS)
+    # Each copied piece used to add the tail of its last AAC frame, so the audio drifted per join
+    assert float(streams["audio"]["duration"]) == pytest.approx(float(streams["video"]["duration"]), abs=0.001)
+    assert float(streams["video"]["duration"]) == pytest.approx(expected, abs=0.001)